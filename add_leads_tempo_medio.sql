@@ -0,0 +1,8 @@
+-- Script para adicionar o tempo de resposta à tabela leads
+-- Preenchido pelo SyncManager.sync_data (SupabaseClient.calculate_response_times)
+
+ALTER TABLE leads
+ADD COLUMN IF NOT EXISTS tempo_medio DOUBLE PRECISION;
+
+-- Comentários para documentar os campos
+COMMENT ON COLUMN leads.tempo_medio IS 'Tempo de resposta em segundos entre a criação do lead e a primeira nota de um usuário';
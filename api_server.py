@@ -37,9 +37,7 @@ def sync_company_data(company_id: UUID, config: dict):
                 # Atualiza status da thread
                 sync_statuses[company_key] = datetime.utcnow()
 
-                brokers = kommo_api.get_users()
-                leads = kommo_api.get_leads()
-                activities = kommo_api.get_activities()
+                brokers, leads, activities = kommo_api.get_all_data()
 
                 if not brokers.empty:
                     brokers = brokers[brokers['cargo'] == 'Corretor']
@@ -74,9 +74,7 @@ def background_data_loader():
                 supabase.check_config_changes()  # Check for config changes
 
                 if sync_manager.needs_sync('brokers') or sync_manager.needs_sync('leads') or sync_manager.needs_sync('activities'):
-                    brokers = kommo_api.get_users()
-                    leads = kommo_api.get_leads()
-                    activities = kommo_api.get_activities()
+                    brokers, leads, activities = kommo_api.get_all_data()
 
                     logger.info(
                         "Iniciando sincronização e atualização de pontos...")
@@ -145,9 +143,7 @@ def sync_data():
         # Reset last sync times to force immediate sync
         sync_manager.last_sync = {k: None for k in sync_manager.last_sync.keys()}
 
-        brokers = kommo_api.get_users()
-        leads = kommo_api.get_leads()
-        activities = kommo_api.get_activities()
+        brokers, leads, activities = kommo_api.get_all_data()
 
         if not brokers.empty and not leads.empty and not activities.empty:
             # Using original sync_from_cache but with reset last_sync times
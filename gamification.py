@@ -27,9 +27,11 @@ def calculate_broker_points(broker_data, lead_data, activity_data, rules, compan
         points_df['pontos'] = 0
         points_df['company_id'] = company_id
 
-        # Inicializar todas as colunas de regras com 0
-        for rule_name in rules.keys():
-            points_df[rule_name] = 0
+        # Inicializar todas as colunas de regras com 0 (um único reindex)
+        points_df = points_df.reindex(
+            columns=list(points_df.columns) + [r for r in rules if r not in points_df.columns],
+            fill_value=0
+        )
 
         now = datetime.now(sao_paulo_tz)
 
@@ -0,0 +1,23 @@
+
+-- Função usada por SupabaseClient.initialize_broker_points: cria, em uma
+-- única chamada, os registros de broker_points (pontuação zerada) dos
+-- corretores da empresa que ainda não têm registro
+CREATE OR REPLACE FUNCTION initialize_broker_points_for_company(p_company_id UUID)
+RETURNS INTEGER
+LANGUAGE sql
+AS $$
+    WITH inserted AS (
+        INSERT INTO broker_points (id, nome, company_id, leads_visitados,
+                                   propostas_enviadas, vendas_realizadas,
+                                   leads_perdidos, pontos, updated_at)
+        SELECT b.id, b.nome, b.company_id, 0, 0, 0, 0, 0, NOW()
+        FROM brokers b
+        WHERE b.cargo = 'Corretor'
+          AND b.company_id = p_company_id
+        ON CONFLICT (id) DO NOTHING
+        RETURNING 1
+    )
+    SELECT COUNT(*)::INTEGER FROM inserted;
+$$;
+
+COMMENT ON FUNCTION initialize_broker_points_for_company(UUID) IS 'Cria registros zerados em broker_points para os corretores da empresa que ainda não têm registro; retorna quantos foram criados';
@@ -0,0 +1,18 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Sessão HTTP compartilhada pelo módulo: reaproveita as conexões TCP/TLS
+# (Kommo API e API interna de sincronização) em vez de abrir uma nova a cada request
+http_session = requests.Session()
+
+# Só falhas de conexão são repetidas aqui (a requisição não chegou ao
+# servidor, então é seguro até para POST); erros HTTP e limites de taxa da
+# Kommo continuam tratados pelos laços de retry de quem chama
+_retry = Retry(total=3, connect=3, read=0, status=0, other=0,
+               backoff_factor=0.3)
+
+_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32,
+                       max_retries=_retry)
+http_session.mount("http://", _adapter)
+http_session.mount("https://", _adapter)
@@ -1,13 +1,20 @@
 import os
 import requests
 import pandas as pd
-from datetime import datetime, timedelta
+import numpy as np
+from datetime import datetime, timedelta, timezone
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import OrderedDict
+import threading
 import time
+import random
 import logging
 import pytz
 from dateutil import parser
 
+from .http_session import http_session
+from .rate_limit_monitor import RateLimitMonitor
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -17,6 +24,17 @@ logger.setLevel(logging.INFO)
 
 sao_paulo_tz = pytz.timezone('America/Sao_Paulo')
 
+# Timeout (conexão, leitura) das requisições à Kommo: uma conexão travada
+# não deve prender a thread de sincronização indefinidamente
+REQUEST_TIMEOUT = (10, 60)
+
+# Cache de notas por lead (get_lead_notes/get_notes_for_leads): máximo de leads e validade em segundos
+NOTES_CACHE_SIZE = 4096
+NOTES_CACHE_TTL = 300
+
+# Leads por consulta ao endpoint em lote leads/notes (filter[entity_id][])
+NOTES_FILTER_CHUNK = 250
+
 
 def parse_datetime_sp(value):
     if not value:
@@ -39,6 +57,21 @@ def parse_datetime_sp(value):
     return dt
 
 
+def to_datetime_sp(values):
+    """
+    Vectorized parse_datetime_sp for a Series of Kommo timestamps.
+    Empty/zero values become NaT.
+    """
+    if pd.api.types.is_numeric_dtype(values):
+        values = values.where(values != 0)
+        return pd.to_datetime(values, unit="s",
+                              utc=True).dt.tz_convert(sao_paulo_tz)
+
+    return pd.Series(
+        [parse_datetime_sp(value) if value else None for value in values],
+        index=values.index)
+
+
 class KommoAPI:
 
     
@@ -56,7 +89,6 @@ class KommoAPI:
         try:
             logger.info("Initializing KommoAPI")
 
-            from .rate_limit_monitor import RateLimitMonitor
             self.rate_monitor = RateLimitMonitor()
 
             self.api_config = api_config
@@ -69,6 +101,10 @@ class KommoAPI:
             self.start_date = None
             self.end_date = None
 
+            # Cache LRU de notas por lead: lead_id -> (DataFrame, expira_em)
+            self._notes_cache = OrderedDict()
+            self._notes_cache_lock = threading.Lock()
+
             if not self.api_url or not self.access_token:
                 raise ValueError("API URL and access token must be provided")
 
@@ -98,14 +134,15 @@ class KommoAPI:
         for attempt in range(retry_count):
             try:
                 # Aplica rate limiting de 7 req/s conforme documentação Kommo
-                self.rate_monitor.enforce_rate_limit()
+                self.rate_monitor.enforce_rate_limit(self.api_url)
 
                 logger.info(f"Making API request to: {url}")
-                response = requests.request(method=method,
-                                            url=url,
-                                            headers=headers,
-                                            params=params,
-                                            json=data)
+                response = http_session.request(method=method,
+                                                url=url,
+                                                headers=headers,
+                                                params=params,
+                                                json=data,
+                                                timeout=REQUEST_TIMEOUT)
 
                 # Log response status and content for debugging
                 logger.info(f"Response status: {response.status_code}")
@@ -121,8 +158,8 @@ class KommoAPI:
                 return response.json()
 
             except requests.exceptions.RequestException as e:
-                status_code = e.response.status_code if hasattr(
-                    e, 'response') else 0
+                # Timeouts/erros de conexão não têm response
+                status_code = getattr(e.response, 'status_code', 0)
 
                 # Usa o novo handler de erros específicos da Kommo
                 if status_code in (429, 403, 504):
@@ -139,7 +176,8 @@ class KommoAPI:
                     )
                     if attempt >= retry_count - 1:
                         raise
-                    time.sleep(2)  # Default delay for non-rate-limit errors
+                    # Backoff exponencial com jitter para erros que não são de rate limit
+                    time.sleep(min(30, 2**attempt) + random.random())
 
     def get_users(self, active_only=True):
         """
@@ -388,46 +426,51 @@ class KommoAPI:
 
             logger.info(f"Total de leads encontrados: {len(filtered_leads)}")
 
-            processed_leads = []
-            for lead in filtered_leads:
-                responsavel_id = lead.get("responsible_user_id")
-                contato_nome = ""
-                if lead.get("_embedded", {}).get("contacts"):
-                    contato_nome = lead["_embedded"]["contacts"][0].get(
-                        "name", "")
-
-                status_id = lead.get("status_id")
-                etapa = status_map.get(status_id, "Desconhecido")
-
-                processed_leads.append({
-                    "id":
-                    lead.get("id"),
-                    "nome":
-                    lead.get("name"),
-                    "responsavel_id":
-                    responsavel_id,
-                    "contato_nome":
-                    contato_nome,
-                    "valor":
-                    lead.get("price"),
-                    "status_id":
-                    status_id,
-                    "pipeline_id":
-                    lead.get("pipeline_id"),
-                    "etapa":
-                    etapa,
-                    "criado_em": (parse_datetime_sp(lead.get("created_at"))
-                                  if lead.get("created_at") else None),
-                    "atualizado_em": (parse_datetime_sp(lead.get("updated_at"))
-                                      if lead.get("updated_at") else None),
-                    "fechado":
-                    lead.get("closed_at") is not None,
-                    "status":
-                    ("Ganho" if status_id == 142 else
-                     "Perdido" if status_id == 143 else "Em progresso")
-                })
+            if not filtered_leads:
+                return pd.DataFrame()
 
-            return pd.DataFrame(processed_leads)
+            # Monta as colunas de uma vez e aplica as conversões sobre o
+            # DataFrame, em vez de tratar cada lead em Python
+            raw = pd.DataFrame(filtered_leads,
+                               columns=[
+                                   "id", "name", "responsible_user_id",
+                                   "price", "status_id", "pipeline_id",
+                                   "created_at", "updated_at", "closed_at"
+                               ])
+            contato_nomes = [
+                (lead.get("_embedded", {}).get("contacts") or [{}])[0].get(
+                    "name", "") for lead in filtered_leads
+            ]
+            status_ids = raw["status_id"]
+
+            return pd.DataFrame({
+                "id":
+                raw["id"],
+                "nome":
+                raw["name"],
+                "responsavel_id":
+                raw["responsible_user_id"],
+                "contato_nome":
+                contato_nomes,
+                "valor":
+                raw["price"],
+                "status_id":
+                status_ids,
+                "pipeline_id":
+                raw["pipeline_id"],
+                "etapa":
+                status_ids.map(status_map).fillna("Desconhecido"),
+                "criado_em":
+                to_datetime_sp(raw["created_at"]),
+                "atualizado_em":
+                to_datetime_sp(raw["updated_at"]),
+                "fechado":
+                raw["closed_at"].notna(),
+                "status":
+                np.select([status_ids.eq(142), status_ids.eq(143)],
+                          ["Ganho", "Perdido"],
+                          default="Em progresso")
+            })
 
         except Exception as e:
             logger.error(f"Erro ao buscar leads: {str(e)}")
@@ -847,12 +890,34 @@ class KommoAPI:
             logger.error(f"Failed to retrieve activities: {str(e)}")
             raise
 
+    def get_all_data(self, active_only=True):
+        """
+        Retrieve users, leads and activities concurrently; the three calls
+        are independent and the shared rate limiter still caps the account
+        at 7 req/s
+        Args:
+            active_only (bool): Passed through to get_users
+        Returns:
+            tuple: (users, leads, activities) DataFrames
+        """
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            users_future = executor.submit(self.get_users,
+                                           active_only=active_only)
+            leads_future = executor.submit(self.get_leads)
+            activities_future = executor.submit(self.get_activities)
+            return (users_future.result(), leads_future.result(),
+                    activities_future.result())
+
     def get_lead_notes(self, lead_id):
         """
         Retrieve notes for a specific lead
         Args:
             lead_id (int): ID of the lead
         """
+        cached = self._get_cached_notes(lead_id)
+        if cached is not None:
+            return cached
+
         try:
             logger.info(f"Retrieving notes for lead {lead_id}")
 
@@ -874,33 +939,163 @@ class KommoAPI:
                 notes_data.extend(notes)
                 page += 1
 
-            processed_notes = []
-            for note in notes_data:
-                # Skip system/automatic notes if possible
-                if note.get("created_by") == 0:  # Sistema
-                    continue
-
-                processed_notes.append({
-                    "id":
-                    note.get("id"),
-                    "lead_id":
-                    lead_id,
-                    "user_id":
-                    note.get("created_by"),
-                    "texto":
-                    note.get("text"),
-                    "criado_em":
-                    datetime.fromtimestamp(note.get("created_at", 0))
-                    if note.get("created_at") else None
-                })
-
-            return pd.DataFrame(processed_notes)
+            notes_df = pd.DataFrame(self._process_notes(notes_data, lead_id))
+            self._cache_notes(lead_id, notes_df)
+            return notes_df.copy()
 
         except Exception as e:
             logger.error(
                 f"Failed to retrieve notes for lead {lead_id}: {str(e)}")
             return pd.DataFrame()
 
+    def _get_cached_notes(self, lead_id):
+        """Return a copy of the cached notes for lead_id, or None if missing/expired"""
+        with self._notes_cache_lock:
+            cached = self._notes_cache.get(lead_id)
+            if cached is None:
+                return None
+            if cached[1] <= time.monotonic():
+                del self._notes_cache[lead_id]
+                return None
+            self._notes_cache.move_to_end(lead_id)
+            return cached[0].copy()
+
+    def _cache_notes(self, lead_id, notes_df):
+        """Store notes for lead_id, evicting the least recently used entries"""
+        with self._notes_cache_lock:
+            self._notes_cache[lead_id] = (notes_df,
+                                          time.monotonic() + NOTES_CACHE_TTL)
+            self._notes_cache.move_to_end(lead_id)
+            while len(self._notes_cache) > NOTES_CACHE_SIZE:
+                self._notes_cache.popitem(last=False)
+
+    def invalidate_lead_notes(self, lead_id=None):
+        """Drop cached notes for one lead, or for all leads when lead_id is None"""
+        with self._notes_cache_lock:
+            if lead_id is None:
+                self._notes_cache.clear()
+            else:
+                self._notes_cache.pop(lead_id, None)
+
+    @staticmethod
+    def _process_notes(notes_data, lead_id=None):
+        """
+        Convert raw Kommo notes into records
+        Args:
+            notes_data (list): Notes as returned by the API
+            lead_id (int): Lead the notes belong to; defaults to each
+                note's entity_id
+        """
+        processed_notes = []
+        for note in notes_data:
+            # Skip system/automatic notes if possible
+            if note.get("created_by") == 0:  # Sistema
+                continue
+
+            processed_notes.append({
+                "id":
+                note.get("id"),
+                "lead_id":
+                lead_id if lead_id is not None else note.get("entity_id"),
+                "user_id":
+                note.get("created_by"),
+                "texto":
+                note.get("text"),
+                "criado_em":
+                datetime.fromtimestamp(note["created_at"], tz=timezone.utc)
+                if note.get("created_at") else None
+            })
+        return processed_notes
+
+    def _get_notes_chunk(self, lead_ids):
+        """
+        Retrieve every note of up to NOTES_FILTER_CHUNK leads through the
+        bulk leads/notes endpoint, filtering by entity_id
+        """
+        notes_data = []
+        page = 1
+
+        while True:
+            response = self._make_request("leads/notes",
+                                          params={
+                                              "filter[entity_id][]": lead_ids,
+                                              "page": page,
+                                              "limit": 250
+                                          })
+
+            notes = response.get("_embedded", {}).get("notes", [])
+            if not notes:
+                break
+
+            notes_data.extend(notes)
+            page += 1
+
+        return self._process_notes(notes_data)
+
+    def get_notes_for_leads(self, lead_ids, max_workers=4):
+        """
+        Retrieve notes for several leads using the bulk leads/notes endpoint
+        (NOTES_FILTER_CHUNK leads per query, 250 notes per page) instead of
+        one request per lead. Leads still in the notes cache are served from
+        it; the ones fetched here are cached for the next runs
+        Args:
+            lead_ids (list): IDs of the leads
+            max_workers (int): Lead chunks fetched in parallel; the shared
+                rate limiter still caps the account at 7 req/s
+        Returns:
+            dict: lead_id -> DataFrame of notes (same format as get_lead_notes)
+        """
+        lead_ids = list(dict.fromkeys(lead_ids))
+        if not lead_ids:
+            return {}
+
+        result = {}
+        missing_ids = []
+        for lead_id in lead_ids:
+            cached = self._get_cached_notes(lead_id)
+            if cached is not None:
+                result[lead_id] = cached
+            else:
+                missing_ids.append(lead_id)
+
+        if not missing_ids:
+            logger.info(f"Notes for {len(lead_ids)} leads served from cache")
+            return result
+
+        logger.info(
+            f"Retrieving notes for {len(missing_ids)} leads ({len(result)} cached)"
+        )
+        chunks = [
+            missing_ids[start:start + NOTES_FILTER_CHUNK]
+            for start in range(0, len(missing_ids), NOTES_FILTER_CHUNK)
+        ]
+
+        notes_by_lead = {lead_id: [] for lead_id in missing_ids}
+        fetched_ids = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(self._get_notes_chunk, chunk): chunk
+                for chunk in chunks
+            }
+            for future in as_completed(futures):
+                try:
+                    for note in future.result():
+                        notes_by_lead.setdefault(note["lead_id"],
+                                                 []).append(note)
+                    fetched_ids.extend(futures[future])
+                except Exception as e:
+                    logger.error(f"Failed to retrieve notes chunk: {str(e)}")
+
+        for lead_id, notes in notes_by_lead.items():
+            result[lead_id] = pd.DataFrame(notes)
+
+        # Only chunks that were actually fetched are cached: a failed chunk
+        # must not be remembered as "no notes"
+        for lead_id in fetched_ids:
+            self._cache_notes(lead_id, result[lead_id].copy())
+
+        return result
+
     def get_tasks(self):
         """
         Retrieve all tasks from Kommo CRM
@@ -1008,10 +1203,12 @@ class KommoAPI:
 
         for attempt in range(retry_count):
             try:
-                self.rate_monitor.enforce_rate_limit()
+                self.rate_monitor.enforce_rate_limit(self.api_url)
 
                 logger.info(f"Making API request to: {full_url}")
-                response = requests.get(full_url, headers=headers)
+                response = http_session.get(full_url,
+                                            headers=headers,
+                                            timeout=REQUEST_TIMEOUT)
 
                 logger.info(f"Response status: {response.status_code}")
                 logger.debug(f"Response content: {response.text[:500]}")
@@ -1025,8 +1222,8 @@ class KommoAPI:
                 return response.json()
 
             except requests.exceptions.RequestException as e:
-                status_code = e.response.status_code if hasattr(
-                    e, 'response') else 0
+                # Timeouts/erros de conexão não têm response
+                status_code = getattr(e.response, 'status_code', 0)
 
                 if status_code in (429, 403, 504):
                     if not self.rate_monitor.handle_kommo_error(
@@ -1042,4 +1239,4 @@ class KommoAPI:
                     )
                     if attempt >= retry_count - 1:
                         raise
-                    time.sleep(2)
+                    time.sleep(min(30, 2**attempt) + random.random())
@@ -1,31 +1,60 @@
 
+import asyncio
 import logging
 import time
-from datetime import datetime, timedelta
-from collections import defaultdict, deque
+from collections import Counter, defaultdict
 import threading
 
 logger = logging.getLogger(__name__)
 
 class RateLimitMonitor:
+    # Buckets compartilhados entre instâncias: o limite da Kommo é por conta,
+    # então todas as instâncias de KommoAPI da mesma conta dividem o mesmo bucket
+    _buckets = {}
+    _buckets_lock = threading.Lock()
+
+    # Código HTTP -> (mensagem de log, nível, se deve tentar novamente)
+    _status_handlers = {
+        # Excesso de solicitações
+        429: ("HTTP 429 - Rate limit exceeded for %s", logging.WARNING, True),
+        # IP bloqueado
+        403: ("HTTP 403 - IP blocked for %s. Check API restrictions.", logging.ERROR, False),
+        # Reduzir número de entidades na solicitação
+        504: ("HTTP 504 - Gateway timeout for %s. Consider reducing batch size.", logging.WARNING, True),
+    }
+
     def __init__(self, max_retries=3, initial_backoff=2):
         self.max_retries = max_retries
         self.initial_backoff = initial_backoff
         self.request_counts = defaultdict(int)
-        self.last_reset = datetime.now()
-        self.error_counts = defaultdict(int)
-        self.reset_interval = timedelta(minutes=15)
+        self.error_counts = Counter()
+        self.max_tracked_endpoints = 1024
+        self.reset_interval = 900.0  # 15 minutos, em segundos
+        self._reset_rate = 1.0 / self.reset_interval
+        self._reset_epoch = int(time.monotonic() * self._reset_rate)
         
         # Rate limiting para Kommo API: máximo 7 solicitações por segundo
         self.max_requests_per_second = 7
-        self.request_times = deque()
-        self.lock = threading.Lock()
+        self._min_interval_ns = 1_000_000_000 // self.max_requests_per_second  # ~143ms entre requests
+        # Capacidade de 1 token mantém o espaçamento mínimo de ~143ms entre requests
+        self.capacity = 1
 
     def reset_counts(self):
-        if datetime.now() - self.last_reset > self.reset_interval:
+        # Contadores zeram a cada janela de 15 minutos: basta comparar o número da janela
+        epoch = int(time.monotonic() * self._reset_rate)
+        if epoch != self._reset_epoch:
             self.request_counts.clear()
             self.error_counts.clear()
-            self.last_reset = datetime.now()
+            self._reset_epoch = epoch
+        elif len(self.error_counts) > self.max_tracked_endpoints:
+            # Mantém só a metade mais recente para limitar a memória entre resets
+            recent = list(self.error_counts.items())[-(self.max_tracked_endpoints // 2):]
+            self.error_counts = Counter(dict(recent))
+
+    @staticmethod
+    def _canonicalize(endpoint):
+        """Remove a query string para que o mesmo endpoint use uma única chave"""
+        return endpoint.split('?', 1)[0]
 
     def calculate_backoff(self, attempt, endpoint):
         """Calculate backoff time with jitter"""
@@ -35,6 +64,7 @@ class RateLimitMonitor:
 
     def should_retry(self, endpoint, status_code):
         self.reset_counts()
+        endpoint = self._canonicalize(endpoint)
         
         # Increment error count
         if status_code in (429, 403):
@@ -52,60 +82,67 @@ class RateLimitMonitor:
         logger.warning(f"Rate limit hit for {endpoint}. Waiting {backoff:.2f}s before retry (attempt {attempt + 1}/{self.max_retries})")
         time.sleep(backoff)
     
-    def enforce_rate_limit(self):
-        """Aplica o rate limiting rigoroso de 7 solicitações por segundo conforme documentação Kommo"""
-        with self.lock:
-            now = time.time()
-            
-            # Remove requests antigas (mais de 1 segundo)
-            while self.request_times and now - self.request_times[0] > 1.0:
-                self.request_times.popleft()
-            
-            # Se já temos 7 requests no último segundo, espera obrigatoriamente
-            if len(self.request_times) >= self.max_requests_per_second:
-                # Calcula o tempo necessário para esperar
-                oldest_request_time = self.request_times[0]
-                time_since_oldest = now - oldest_request_time
-                sleep_time = 1.0 - time_since_oldest + 0.01  # +10ms de margem de segurança
-                
-                if sleep_time > 0:
-                    logger.info(f"Rate limit: waiting {sleep_time:.3f}s to respect 7 req/s limit")
-                    time.sleep(sleep_time)
-                    # Atualiza o tempo atual após o sleep
-                    now = time.time()
-                    
-                    # Remove requests antigas novamente após o sleep
-                    while self.request_times and now - self.request_times[0] > 1.0:
-                        self.request_times.popleft()
-            
-            # Adiciona delay mínimo entre requests para distribuir melhor
-            min_interval = 1.0 / self.max_requests_per_second  # ~0.143s entre requests
-            if self.request_times:
-                time_since_last = now - self.request_times[-1]
-                if time_since_last < min_interval:
-                    additional_sleep = min_interval - time_since_last
-                    logger.debug(f"Adding minimum interval delay: {additional_sleep:.3f}s")
-                    time.sleep(additional_sleep)
-                    now = time.time()
-            
-            # Registra a nova request
-            self.request_times.append(now)
+    def reserve(self, n, key=None):
+        """
+        Reserva n slots consecutivos do bucket com uma única aquisição do lock
+
+        Args:
+            n (int): Número de requests que o chamador vai disparar
+            key (str): Identificador da conta Kommo (ex.: api_url)
+
+        Returns:
+            list: Horários (time.monotonic_ns) a partir dos quais cada request pode ser feita
+        """
+        self.reset_counts()
+        interval = self._min_interval_ns
+        # Quantos slots podem ser antecipados em relação ao ritmo constante (burst)
+        tolerance = (self.capacity - 1) * interval
+        with self._buckets_lock:
+            now = time.monotonic_ns()
+            # O bucket guarda o horário teórico do próximo slot livre, em nanossegundos;
+            # avançá-lo para o futuro é a reserva, então chamadas concorrentes dormem
+            # em paralelo sem enfileirar no lock
+            start = self._buckets.get(key, now)
+            if start < now:
+                start = now
+            self._buckets[key] = start + n * interval
+        
+        return [max(now, start + i * interval - tolerance) for i in range(n)]
+
+    def _reserve_slot(self, key):
+        """Reserva o próximo slot do bucket e retorna quanto tempo esperar por ele, em segundos"""
+        sleep_ns = self.reserve(1, key)[0] - time.monotonic_ns()
+        if sleep_ns <= 0:
+            return 0.0
+        sleep_time = sleep_ns / 1_000_000_000
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Rate limit: waiting %.3fs to respect 7 req/s limit", sleep_time)
+        return sleep_time
+
+    def enforce_rate_limit(self, key=None):
+        """Aplica o rate limiting rigoroso de 7 solicitações por segundo conforme documentação Kommo
+
+        Args:
+            key (str): Identificador da conta Kommo (ex.: api_url). Contas diferentes
+                têm buckets independentes e não se bloqueiam entre si.
+        """
+        sleep_time = self._reserve_slot(key)
+        if sleep_time > 0:
+            time.sleep(sleep_time)
+
+    async def enforce_rate_limit_async(self, key=None):
+        """Versão assíncrona de enforce_rate_limit: espera com asyncio.sleep sem bloquear o event loop"""
+        sleep_time = self._reserve_slot(key)
+        if sleep_time > 0:
+            await asyncio.sleep(sleep_time)
     
     def handle_kommo_error(self, status_code, endpoint, attempt):
         """Trata códigos de erro específicos da API Kommo"""
-        if status_code == 429:
-            # Código HTTP 429: excesso de solicitações
-            logger.warning(f"HTTP 429 - Rate limit exceeded for {endpoint}")
-            return self.should_retry(endpoint, status_code)
-        
-        elif status_code == 403:
-            # Código HTTP 403: IP bloqueado
-            logger.error(f"HTTP 403 - IP blocked for {endpoint}. Check API restrictions.")
-            return False  # Não tenta novamente para IP bloqueado
+        handler = self._status_handlers.get(status_code)
+        if handler is None:
+            return True
         
-        elif status_code == 504:
-            # Código HTTP 504: Reduzir número de entidades na solicitação
-            logger.warning(f"HTTP 504 - Gateway timeout for {endpoint}. Consider reducing batch size.")
-            return self.should_retry(endpoint, status_code)
-        
-        return True
+        message, level, retry = handler
+        logger.log(level, message, endpoint)
+        # 403 (IP bloqueado) nunca é tentado novamente
+        return self.should_retry(endpoint, status_code) if retry else False
@@ -1,19 +1,109 @@
 import os
-from libs.kommo_api import KommoAPI
+from libs.kommo_api import KommoAPI, REQUEST_TIMEOUT
 from libs.sync_manager import SyncManager
-from supabase import create_client
+from libs.http_session import http_session
+from supabase import create_client, ClientOptions
+from postgrest.types import ReturnMethod
+from postgrest.exceptions import APIError
 import pandas as pd
 import numpy as np
 import logging
 from datetime import datetime, timedelta
-import requests
+import pytz
+import httpx
 import time
+import random
+import threading
+import atexit
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Quantidade máxima de registros por requisição de upsert ao PostgREST
+UPSERT_CHUNK_SIZE = 2000
+
+# Tamanho de lote por tabela: linhas estreitas (brokers, broker_points) cabem
+# em lotes maiores; atividades carregam valor_antigo/valor_novo em JSON
+UPSERT_CHUNK_SIZES = {
+    "brokers": 5000,
+    "broker_points": 5000,
+    "leads": 2000,
+    "activities": 1000,
+}
+
+# Lotes de upsert enviados em paralelo e tentativas por lote (com backoff
+# exponencial e jitter) antes de propagar o erro
+UPSERT_MAX_WORKERS = 4
+UPSERT_RETRIES = 3
+
+# Só falhas transitórias são repetidas: conexão/timeout, HTTP 429 e 5xx, e
+# os códigos do Postgres/PostgREST abaixo (conexão, deadlock, serialização,
+# timeout de statement, falta de recursos). Erros do payload (FK, coluna
+# inexistente, tipo inválido) falham de imediato
+TRANSIENT_DB_ERROR_PREFIXES = ("08", "53", "57P", "PGRST000", "PGRST001",
+                               "PGRST002", "PGRST003")
+TRANSIENT_DB_ERROR_CODES = frozenset(("40001", "40P01", "57014"))
+
+# Máximo de linhas por resposta do PostgREST (max-rows padrão do Supabase)
+POSTGREST_MAX_ROWS = 1000
+
+# Códigos de erro de função SQL inexistente (PostgREST / Postgres)
+MISSING_FUNCTION_ERROR_CODES = frozenset(("PGRST202", "42883"))
+
+# Quantidade máxima de ids por filtro in_() (limite de tamanho da URL)
+IN_FILTER_CHUNK_SIZE = 1000
+
+# Tempo de vida (segundos) dos caches de regras, de company_id e de ids
+# existentes (leads/brokers usados para validar as atividades)
+RULES_CACHE_TTL = 300
+COMPANY_ID_CACHE_TTL = 3600
+EXISTING_IDS_CACHE_TTL = 300
+
+# Campos de pontuação zerados ao criar um registro em broker_points
+BROKER_POINTS_ZERO_COLUMNS = ("leads_visitados", "propostas_enviadas",
+                              "vendas_realizadas", "leads_perdidos", "pontos")
+
+# Intervalo (segundos) entre consultas à kommo_config: começa no mínimo,
+# cresce CONFIG_CHECK_BACKOFF vezes a cada consulta sem mudança até o máximo
+# e volta ao mínimo quando a configuração muda
+CONFIG_CHECK_MIN_INTERVAL = 30
+CONFIG_CHECK_MAX_INTERVAL = 300
+CONFIG_CHECK_BACKOFF = 1.5
+
+# Campos de kommo_config atualizados pelo próprio sync, ignorados ao
+# detectar mudanças de configuração
+CONFIG_SYNC_FIELDS = frozenset(("last_sync", "next_sync"))
+
+# Gravação em lote da tabela sync_logs
+LOG_BATCH_SIZE = 500
+LOG_FLUSH_INTERVAL = 5  # segundos
+
+# Máximo de empresas sincronizadas em paralelo no carregamento das configs
+COMPANY_SYNC_MAX_WORKERS = 8
+
+# Pool de conexões HTTP do cliente Supabase (PostgREST): lotes de upsert e
+# consultas paralelas reaproveitam conexões keep-alive, sem passar do limite
+SUPABASE_MAX_CONNECTIONS = int(os.getenv("SUPABASE_MAX_CONNECTIONS", "40"))
+SUPABASE_MAX_KEEPALIVE = 20
+SUPABASE_KEEPALIVE_EXPIRY = 40  # segundos
+SUPABASE_TIMEOUT = 120  # segundos, o mesmo padrão do postgrest-py
+
+# Instâncias cujos logs pendentes são gravados na saída do interpretador.
+# WeakSet: registrar cada instância no atexit a manteria viva (com o pool
+# HTTP) até o processo terminar; enquanto há logs no buffer, o Timer de
+# flush_logs já mantém a instância viva
+_log_clients = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_all_logs():
+    for client in list(_log_clients):
+        client.flush_logs()
+
 
 class SupabaseClient:
 
@@ -24,12 +114,39 @@ class SupabaseClient:
         if not self.url or not self.key:
             raise ValueError("Supabase URL and key must be provided")
 
+        # Logs de sync_logs são acumulados e gravados em lotes: quando o buffer
+        # enche ou, no máximo, LOG_FLUSH_INTERVAL segundos após o primeiro log
+        self._log_buffer = []
+        self._log_lock = threading.Lock()
+        self._log_timer = None
+        _log_clients.add(self)
+
+        # Caches com TTL: company_id -> (regras, expira_em),
+        # (api_url, access_token) -> (company_id, expira_em) e
+        # tabela -> (ids existentes, expira_em)
+        self._rules_cache = {}
+        self._company_id_cache = {}
+        self._existing_ids_cache = {}
+
         try:
-            self.client = create_client(self.url, self.key)
+            http_client = httpx.Client(
+                timeout=SUPABASE_TIMEOUT,
+                limits=httpx.Limits(
+                    max_connections=SUPABASE_MAX_CONNECTIONS,
+                    max_keepalive_connections=SUPABASE_MAX_KEEPALIVE,
+                    keepalive_expiry=SUPABASE_KEEPALIVE_EXPIRY))
+            self.client = create_client(
+                self.url,
+                self.key,
+                options=ClientOptions(httpx_client=http_client))
             logger.info("Supabase client initialized successfully")
+            # Consulta reutilizada a cada verificação de configuração; o
+            # builder não é alterado por execute(), então pode ser mantido
+            self._config_query = self.client.table("kommo_config").select("*")
             self.kommo_config = None
             self.rules = None
-            self.last_check = datetime.now()
+            self.last_check = time.monotonic()
+            self._config_check_interval = CONFIG_CHECK_MIN_INTERVAL
 
             # Try initial load of config and rules
             self._load_initial_config()
@@ -46,15 +163,7 @@ class SupabaseClient:
             if config.data:
                 self.kommo_config = config.data[0]
 
-                if not self.kommo_config.get('company_id'):
-                    company_id = self._get_company_id(
-                        self.kommo_config['api_url'],
-                        self.kommo_config['access_token'])
-                    self.client.table("kommo_config").update({
-                        'company_id':
-                        company_id
-                    }).eq('id', self.kommo_config['id']).execute()
-                    self.kommo_config['company_id'] = company_id
+                self._ensure_company_id(self.kommo_config)
 
                 try:
                     self.rules = self.load_rules()
@@ -69,22 +178,36 @@ class SupabaseClient:
         except Exception as e:
             logger.error(f"Error loading initial configuration: {str(e)}")
 
+    @staticmethod
+    def _config_changed(old_config, new_config):
+        """
+        Compara duas linhas de kommo_config ignorando os campos de controle
+        (last_sync/next_sync) que a própria sincronização atualiza
+
+        Returns:
+            bool: True se algum campo de configuração mudou
+        """
+        if not old_config:
+            return bool(new_config)
+        keys = (old_config.keys() | new_config.keys()) - CONFIG_SYNC_FIELDS
+        return any(old_config.get(k) != new_config.get(k) for k in keys)
+
+    def invalidate_caches(self):
+        """Descarta os caches de regras, de company_id e de ids existentes"""
+        self._rules_cache.clear()
+        self._company_id_cache.clear()
+        self._existing_ids_cache.clear()
+
     def _handle_config_update(self, updated_config):
         """Handle kommo_config updates"""
         try:
-            if updated_config and updated_config != self.kommo_config:
+            if updated_config and self._config_changed(self.kommo_config,
+                                                       updated_config):
                 logger.info("Kommo configuration updated")
                 self.kommo_config = updated_config
+                self.invalidate_caches()
 
-                if not updated_config.get('company_id'):
-                    company_id = self._get_company_id(
-                        updated_config['api_url'],
-                        updated_config['access_token'])
-                    self.client.table("kommo_config").update({
-                        'company_id':
-                        company_id
-                    }).eq('id', updated_config['id']).execute()
-                    updated_config['company_id'] = company_id
+                self._ensure_company_id(updated_config)
 
                 self._sync_all_data(updated_config)
                 logger.info("Configuration update handled successfully")
@@ -94,41 +217,40 @@ class SupabaseClient:
     def check_config_changes(self):
         """Check for configuration changes periodically"""
         try:
-            current_time = datetime.now()
-            if (current_time - self.last_check
-                ).total_seconds() < 30:  # Check every 30 seconds
+            current_time = time.monotonic()
+            if current_time - self.last_check < self._config_check_interval:
                 return
 
             self.last_check = current_time
-            result = self.client.table("kommo_config").select("*").execute()
-
-            if not result.data:
+            result = self._config_query.execute()
+
+            if not result.data or (
+                    self.kommo_config and
+                    not self._config_changed(self.kommo_config, result.data[0])):
+                # Nada mudou: espaça a próxima consulta
+                self._config_check_interval = min(
+                    self._config_check_interval * CONFIG_CHECK_BACKOFF,
+                    CONFIG_CHECK_MAX_INTERVAL)
+                if result.data:
+                    # Só os campos de controle do sync mudaram: atualiza a
+                    # cópia local sem disparar uma nova sincronização
+                    self.kommo_config = result.data[0]
                 return
 
             new_config = result.data[0]
+            self._config_check_interval = CONFIG_CHECK_MIN_INTERVAL
 
             if not self.kommo_config:
                 logger.info("New Kommo configuration detected")
                 self._handle_config_insert({"new": new_config})
-            elif new_config != self.kommo_config:
-                logger.info("Kommo configuration updated")
+            else:
+                # _handle_config_update já garante o company_id e sincroniza;
+                # repetir aqui fazia uma segunda sincronização completa
                 self._handle_config_update(new_config)
 
                 # Atualiza a cópia da config local
                 self.kommo_config = new_config
 
-                if not new_config.get('company_id'):
-                    company_id = self._get_company_id(
-                        new_config['api_url'], new_config['access_token'])
-                    self.client.table("kommo_config").update({
-                        'company_id':
-                        company_id
-                    }).eq('id', new_config['id']).execute()
-                    new_config['company_id'] = company_id
-
-                self._sync_all_data(new_config)
-                logger.info("Configuration update handled successfully")
-
         except Exception as e:
             logger.error(f"Failed to check or handle config changes: {str(e)}")
 
@@ -141,9 +263,7 @@ class SupabaseClient:
                                  supabase_client=self)
             sync_manager = SyncManager(kommo_api, self, config)
 
-            brokers = kommo_api.get_users()
-            leads = kommo_api.get_leads()
-            activities = kommo_api.get_activities()
+            brokers, leads, activities = kommo_api.get_all_data()
 
             # Add company_id to all DataFrames
             if not brokers.empty:
@@ -192,14 +312,20 @@ class SupabaseClient:
 
                 # Trigger sync through FastAPI endpoint
                 try:
-                    response = requests.post("http://0.0.0.0:5002/start")
+                    response = http_session.post("http://0.0.0.0:5002/start",
+                                                 timeout=REQUEST_TIMEOUT)
                     if response.status_code == 200:
                         logger.info("Sync started for all companies")
 
+                        # Backoff exponencial: detecta rápido syncs curtos sem
+                        # consultar o status a cada poucos segundos em syncs longos.
+                        # O jitter evita que várias instâncias consultem juntas.
+                        delay = 1
                         while True:
                             try:
-                                status_response = requests.get(
-                                    "http://0.0.0.0:5002/status")
+                                status_response = http_session.get(
+                                    "http://0.0.0.0:5002/status",
+                                    timeout=REQUEST_TIMEOUT)
                                 if status_response.status_code == 200:
                                     all_status = status_response.json()
                                     company_status = all_status.get(
@@ -215,10 +341,11 @@ class SupabaseClient:
 
                                     if status in ('initializing', 'running'):
                                         logger.info(
-                                            f"Company {company_id} sync in progress: {status}"
+                                            f"Company {company_id} sync in progress: {status}. Checking again in {delay}s"
                                         )
-                                        time.sleep(
-                                            30)  # Check every 30 seconds
+                                        time.sleep(delay +
+                                                   random.uniform(0, 1))
+                                        delay = min(delay * 2, 60)
                                         continue
                                     else:
                                         logger.info(
@@ -245,21 +372,49 @@ class SupabaseClient:
             raise
 
     def insert_log(self, type: str, message: str):
-        """Insere um log na tabela sync_logs"""
+        """Adiciona um log ao buffer da tabela sync_logs, gravado em lotes"""
         try:
-            self.client.table("sync_logs").insert({
-                "timestamp":
-                datetime.now().isoformat(),
-                "type":
-                type,
-                "message":
-                message,
-                "company_id":
-                self.kommo_config.get('company_id')
-            }).execute()
+            with self._log_lock:
+                self._log_buffer.append({
+                    "timestamp":
+                    datetime.now().isoformat(),
+                    "type":
+                    type,
+                    "message":
+                    message,
+                    "company_id":
+                    self.kommo_config.get('company_id')
+                })
+                should_flush = len(self._log_buffer) >= LOG_BATCH_SIZE
+                if not should_flush and self._log_timer is None:
+                    # Garante a gravação mesmo que nenhum outro log chegue
+                    self._log_timer = threading.Timer(LOG_FLUSH_INTERVAL,
+                                                      self.flush_logs)
+                    self._log_timer.daemon = True
+                    self._log_timer.start()
+            if should_flush:
+                self.flush_logs()
         except Exception as e:
             logger.error(f"Failed to insert log: {str(e)}")
 
+    def flush_logs(self):
+        """Grava na tabela sync_logs, com um único insert, os logs acumulados no buffer"""
+        with self._log_lock:
+            pending = self._log_buffer
+            self._log_buffer = []
+            if self._log_timer is not None:
+                self._log_timer.cancel()
+                self._log_timer = None
+
+        if not pending:
+            return
+
+        try:
+            self.client.table("sync_logs").insert(
+                pending, returning=ReturnMethod.minimal).execute()
+        except Exception as e:
+            logger.error(f"Failed to insert {len(pending)} logs: {str(e)}")
+
     def load_kommo_config(self, company_id=None):
         """Load Kommo API configuration from Supabase"""
         try:
@@ -278,30 +433,68 @@ class SupabaseClient:
                 return []
 
             configs = result.data
-            for config in configs:
-                if config.get('company_id') is None:
-                    company_id = self._get_company_id(config['api_url'],
-                                                      config['access_token'])
-                    self.client.table("kommo_config").update({
-                        'company_id':
-                        company_id
-                    }).eq('id', config['id']).execute()
-                    config['company_id'] = company_id
-                    self._sync_all_data(config)
+            pending = [
+                config for config in configs
+                if config.get('company_id') is None
+            ]
+            if pending:
+                # Cada empresa é uma conta Kommo diferente (limite de requisições
+                # próprio), então as sincronizações podem rodar em paralelo.
+                # list() propaga a primeira exceção, como no laço sequencial
+                with ThreadPoolExecutor(max_workers=min(
+                        COMPANY_SYNC_MAX_WORKERS, len(pending))) as executor:
+                    list(executor.map(self._setup_company_config, pending))
 
             return configs
         except Exception as e:
             logger.error(f"Failed to load Kommo config: {str(e)}")
             raise
 
+    def _setup_company_config(self, config):
+        """Resolve e grava o company_id de uma config nova e faz a carga inicial"""
+        self._ensure_company_id(config)
+        self._sync_all_data(config)
+
+    def _ensure_company_id(self, config):
+        """
+        Garante que a config tenha company_id: se faltar, busca na Kommo
+        (com cache) e grava na kommo_config; se já existir, não faz nenhuma
+        requisição
+
+        Args:
+            config (dict): Registro da kommo_config (atualizado in-place)
+
+        Returns:
+            O company_id da config
+        """
+        if config.get('company_id'):
+            return config['company_id']
+
+        company_id = self._get_company_id(config['api_url'],
+                                          config['access_token'])
+        self.client.table("kommo_config").update({
+            'company_id': company_id
+        }).eq('id', config['id']).execute()
+        config['company_id'] = company_id
+        return company_id
+
     def _get_company_id(self, api_url, access_token):
-        """Get company ID from Kommo API"""
+        """Get company ID from Kommo API (cached for COMPANY_ID_CACHE_TTL seconds)"""
+        cache_key = (api_url, access_token)
+        cached = self._company_id_cache.get(cache_key)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+
         try:
-            response = requests.get(
+            response = http_session.get(
                 f"{api_url}/api/v4/account",
-                headers={"Authorization": f"Bearer {access_token}"})
+                headers={"Authorization": f"Bearer {access_token}"},
+                timeout=REQUEST_TIMEOUT)
             response.raise_for_status()
-            return response.json().get('id')
+            company_id = response.json().get('id')
+            self._company_id_cache[cache_key] = (
+                company_id, time.monotonic() + COMPANY_ID_CACHE_TTL)
+            return company_id
         except Exception as e:
             logger.error(f"Failed to get company ID: {str(e)}")
             raise
@@ -312,9 +505,7 @@ class SupabaseClient:
             kommo_api = KommoAPI(api_url=config['api_url'],
                                  access_token=config['access_token'],
                                  supabase_client=self)
-            brokers = kommo_api.get_users()
-            leads = kommo_api.get_leads()
-            activities = kommo_api.get_activities()
+            brokers, leads, activities = kommo_api.get_all_data()
 
             # Add company_id to all DataFrames
             for df in [brokers, leads, activities]:
@@ -334,13 +525,17 @@ class SupabaseClient:
             raise
 
     def load_rules(self, company_id=None):
-        """Load gamification rules from Supabase for specific company"""
+        """Load gamification rules from Supabase for specific company (cached for RULES_CACHE_TTL seconds)"""
         try:
             company_id = company_id or self.kommo_config.get('company_id')
             if not company_id:
                 logger.warning("No company_id provided for loading rules")
                 return {}
 
+            cached = self._rules_cache.get(company_id)
+            if cached and cached[1] > time.monotonic():
+                return dict(cached[0])
+
             # First try to load company-specific rules from company_rules table
             company_rules_result = self.client.table("company_rules").select(
                 """
@@ -353,16 +548,17 @@ class SupabaseClient:
 
             if company_rules_result.data:
                 # Use company-specific rule points
-                for rule in company_rules_result.data:
-                    rules_dict[rule['rules']['coluna_nome']] = rule['pontos']
+                rules_dict.update(
+                    (rule['rules']['coluna_nome'], rule['pontos'])
+                    for rule in company_rules_result.data)
                 logger.info(f"Loaded {len(rules_dict)} company-specific rules")
             else:
                 # Fallback to default rules
                 result = self.client.table("rules").select("*").eq(
                     "company_id", company_id).execute()
                 if result.data:
-                    for rule in result.data:
-                        rules_dict[rule['coluna_nome']] = rule['pontos']
+                    rules_dict.update((rule['coluna_nome'], rule['pontos'])
+                                      for rule in result.data)
                     logger.info(f"Loaded {len(rules_dict)} default rules")
                 else:
                     logger.warning("No rules found for company")
@@ -372,16 +568,234 @@ class SupabaseClient:
                 "*").eq("company_id", company_id).eq("active", True).execute()
 
             if custom_rules_result.data:
-                for rule in custom_rules_result.data:
-                    rules_dict[rule['coluna_nome']] = rule['pontos']
+                rules_dict.update((rule['coluna_nome'], rule['pontos'])
+                                  for rule in custom_rules_result.data)
                 logger.info(
                     f"Added {len(custom_rules_result.data)} custom rules")
 
+            self._rules_cache[company_id] = (dict(rules_dict),
+                                             time.monotonic() + RULES_CACHE_TTL)
             return rules_dict
         except Exception as e:
             logger.error(f"Failed to load rules: {str(e)}")
             return {}
 
+    def _upsert_chunked(self,
+                        table,
+                        records,
+                        chunk_size=None,
+                        on_conflict=None,
+                        max_workers=UPSERT_MAX_WORKERS):
+        """
+        Faz o upsert dos registros em lotes, mantendo cada requisição dentro
+        dos limites de tamanho do PostgREST. Os lotes são enviados em paralelo
+        e cada um é tentado até UPSERT_RETRIES vezes antes de propagar o erro
+
+        Args:
+            table (str): Nome da tabela
+            records (list): Registros a enviar
+            chunk_size (int): Máximo de registros por requisição (padrão:
+                UPSERT_CHUNK_SIZES da tabela, ou UPSERT_CHUNK_SIZE)
+            on_conflict (str): Coluna(s) de conflito do upsert
+            max_workers (int): Lotes enviados ao mesmo tempo
+
+        Returns:
+            list: Respostas de cada lote, na ordem dos registros (sem as
+                linhas: Prefer return=minimal)
+        """
+        if chunk_size is None:
+            chunk_size = UPSERT_CHUNK_SIZES.get(table, UPSERT_CHUNK_SIZE)
+
+        # Ninguém lê as linhas gravadas: return=minimal evita que o PostgREST
+        # devolva (e o cliente decodifique) um JSON do tamanho do lote
+        options = {"returning": ReturnMethod.minimal}
+        if on_conflict:
+            options["on_conflict"] = on_conflict
+
+        chunks = [
+            records[start:start + chunk_size]
+            for start in range(0, len(records), chunk_size)
+        ]
+
+        def upsert_chunk(chunk):
+            for attempt in range(UPSERT_RETRIES):
+                try:
+                    result = self.client.table(table).upsert(
+                        chunk, **options).execute()
+
+                    if hasattr(result, "error") and result.error:
+                        raise Exception(f"Supabase error: {result.error}")
+
+                    return result
+                except Exception as e:
+                    if (attempt == UPSERT_RETRIES - 1
+                            or not self._is_transient_error(e)):
+                        raise
+                    delay = 2**attempt + random.uniform(0, 1)
+                    logger.warning(
+                        f"Upsert of {len(chunk)} records into {table} failed "
+                        f"(attempt {attempt + 1}/{UPSERT_RETRIES}), retrying in {delay:.1f}s: {str(e)}"
+                    )
+                    time.sleep(delay)
+
+        if len(chunks) <= 1 or max_workers <= 1:
+            return [upsert_chunk(chunk) for chunk in chunks]
+
+        # Os ids já chegam sem repetição, então lotes paralelos nunca disputam
+        # a mesma linha; map() preserva a ordem e propaga o primeiro erro
+        with ThreadPoolExecutor(
+                max_workers=min(max_workers, len(chunks))) as executor:
+            return list(executor.map(upsert_chunk, chunks))
+
+    @staticmethod
+    def _is_transient_error(error):
+        """
+        Indica se vale a pena repetir a requisição que falhou com error:
+        falhas de transporte (conexão, timeout), HTTP 429/5xx e os códigos
+        transitórios do Postgres/PostgREST. Erros de payload não são repetidos
+
+        Args:
+            error (Exception): Exceção levantada pelo execute()
+
+        Returns:
+            bool: True se a falha for transitória
+        """
+        if isinstance(error, httpx.TransportError):
+            return True
+        if not isinstance(error, APIError):
+            return False
+
+        # Sem corpo JSON, o postgrest-py usa o status HTTP como código
+        code = str(error.code or "")
+        if len(code) == 3 and code.isdigit():
+            return code == "429" or code.startswith("5")
+        return (code in TRANSIENT_DB_ERROR_CODES
+                or code.startswith(TRANSIENT_DB_ERROR_PREFIXES))
+
+    @staticmethod
+    def _to_records(df):
+        """
+        Converte o DataFrame em lista de dicts (mesmo resultado de
+        to_dict(orient="records")), convertendo coluna a coluna com tolist()
+        em vez de converter cada valor individualmente por linha
+        """
+        columns = list(df.columns)
+        return [
+            dict(zip(columns, row))
+            for row in zip(*(df[col].tolist() for col in columns))
+        ]
+
+    @staticmethod
+    def _datetimes_to_iso(df, columns=None):
+        """
+        Converte colunas datetime64 (com ou sem timezone) para strings ISO 8601
+        com .dt.strftime, em vez de chamar isoformat() linha a linha.
+        NaT vira None (null no JSON). Altera o DataFrame recebido.
+
+        Args:
+            df (pandas.DataFrame): DataFrame a converter
+            columns (list): Colunas a converter (padrão: todas as datetime)
+
+        Returns:
+            pandas.DataFrame: O mesmo DataFrame, com as colunas convertidas
+        """
+        if columns is None:
+            columns = df.select_dtypes(include=['datetime', 'datetimetz']).columns
+        for col in columns:
+            if col not in df.columns or not pd.api.types.is_datetime64_any_dtype(df[col]):
+                continue
+            iso = df[col].dt.strftime('%Y-%m-%dT%H:%M:%S.%f%z')
+            df[col] = iso.astype(object).where(df[col].notna(), None)
+        return df
+
+    @staticmethod
+    def distinct_ids(df, column):
+        """Retorna os ids distintos (int) não nulos de uma coluna do DataFrame"""
+        if column not in df.columns:
+            return []
+        ids = pd.to_numeric(df[column], errors='coerce').dropna()
+        return ids.astype('int64').unique().tolist()
+
+    @staticmethod
+    def existing_id_mask(series, existing_ids):
+        """
+        Máscara booleana das linhas cujo id é nulo ou existe em existing_ids,
+        calculada com np.isin sobre int64 em vez de isin com objetos Python
+
+        Args:
+            series (pandas.Series): Coluna de ids (pode conter None/NaN)
+            existing_ids (set): Ids existentes no banco
+
+        Returns:
+            numpy.ndarray: Máscara booleana alinhada com a série
+        """
+        values = pd.to_numeric(series, errors='coerce').to_numpy(
+            dtype=float, na_value=np.nan)
+        missing = ~np.isfinite(values)
+        ids = np.fromiter(existing_ids, dtype=np.int64,
+                          count=len(existing_ids))
+        return missing | np.isin(
+            np.where(missing, -1, values).astype(np.int64), ids)
+
+    def select_existing_ids(self,
+                            table,
+                            ids,
+                            chunk_size=IN_FILTER_CHUNK_SIZE,
+                            company_id=None):
+        """
+        Verifica quais dos ids informados existem na tabela, consultando apenas
+        esses ids (em lotes de in_) em vez de trazer a tabela inteira. Ids já
+        vistos nos últimos EXISTING_IDS_CACHE_TTL segundos não são consultados
+        de novo
+
+        Args:
+            table (str): Nome da tabela
+            ids (list): Ids a verificar
+            chunk_size (int): Máximo de ids por consulta
+            company_id (str): Se informado, só contam os ids desta empresa
+                (o cache é separado por empresa)
+
+        Returns:
+            set: Ids encontrados na tabela
+        """
+        known_ids = self._known_ids(table, company_id)
+        missing = [i for i in ids if i not in known_ids]
+        for start in range(0, len(missing), chunk_size):
+            query = self.client.table(table).select("id").in_(
+                "id", missing[start:start + chunk_size])
+            if company_id is not None:
+                query = query.eq("company_id", company_id)
+            result = query.execute()
+            if hasattr(result, "error") and result.error:
+                raise Exception(
+                    f"Supabase error querying {table}: {result.error}")
+            known_ids.update(row['id'] for row in result.data)
+        return {i for i in ids if i in known_ids}
+
+    def remember_existing_ids(self, table, ids, company_id=None):
+        """
+        Registra ids que acabaram de ser gravados na tabela, para que
+        select_existing_ids não precise consultá-los
+
+        Args:
+            table (str): Nome da tabela
+            ids (iterable): Ids gravados
+            company_id (str): Empresa dona dos registros gravados
+        """
+        self._known_ids(table, company_id).update(ids)
+
+    def _known_ids(self, table, company_id=None):
+        """
+        Retorna o conjunto (mutável) de ids sabidamente existentes na tabela
+        (e na empresa, se informada), recomeçando do zero quando o TTL expira
+        """
+        key = (table, company_id)
+        cached = self._existing_ids_cache.get(key)
+        if cached is None or cached[1] <= time.monotonic():
+            cached = (set(), time.monotonic() + EXISTING_IDS_CACHE_TTL)
+            self._existing_ids_cache[key] = cached
+        return cached[0]
+
     def upsert_brokers(self, brokers_df):
         """
         Insert or update broker data in the Supabase database
@@ -396,37 +810,116 @@ class SupabaseClient:
 
             logger.info(f"Upserting {len(brokers_df)} brokers to Supabase")
 
-            # Filtrar apenas corretores
-            brokers_df_filtered = brokers_df[brokers_df['cargo'] ==
-                                             'Corretor'].copy()
+            # Filtrar apenas corretores, mantendo a última ocorrência de cada id
+            # (ids repetidos no mesmo lote fazem o upsert falhar).
+            # assign já devolve um DataFrame novo
+            brokers_df_filtered = brokers_df[
+                (brokers_df['cargo'] == 'Corretor')
+                & ~brokers_df['id'].duplicated(keep='last')].assign(
+                    updated_at=datetime.now().isoformat())
 
             if brokers_df_filtered.empty:
                 logger.warning("No brokers with 'Corretor' role found")
                 return
 
             # Convert DataFrame to list of dicts
-            brokers_data = brokers_df_filtered.to_dict(orient="records")
-
-            # Add updated_at timestamp
-            for broker in brokers_data:
-                broker["updated_at"] = datetime.now().isoformat()
+            brokers_data = self._to_records(brokers_df_filtered)
 
             # Upsert data to Supabase - inserir novos e atualizar existentes
-            result = self.client.table("brokers").upsert(
-                brokers_data, on_conflict='id').execute()
+            results = self._upsert_chunked("brokers",
+                                           brokers_data,
+                                           on_conflict='id')
 
-            if hasattr(result, "error") and result.error:
-                raise Exception(f"Supabase error: {result.error}")
+            # Os corretores enviados passam a existir: upsert_activities não
+            # precisa consultá-los de novo
+            self.remember_existing_ids("brokers",
+                                       brokers_df_filtered['id'].tolist())
 
             logger.info(
                 f"Brokers upserted successfully: {len(brokers_data)} records processed"
             )
-            return result
+            return results
 
         except Exception as e:
             logger.error(f"Failed to upsert brokers: {str(e)}")
             raise
 
+    def upsert_leads(self, leads_df):
+        """
+        Insert or update lead data in the Supabase database
+
+        Args:
+            leads_df (pandas.DataFrame): DataFrame containing lead data
+        """
+        try:
+            if leads_df.empty:
+                logger.warning("No lead data to insert")
+                return
+
+            logger.info(f"Processing {len(leads_df)} leads")
+
+            # Leads whose responsavel_id is not a known broker would violate
+            # the foreign key and fail the whole chunk
+            try:
+                existing_broker_ids = self.select_existing_ids(
+                    "brokers", self.distinct_ids(leads_df, 'responsavel_id'))
+            except Exception as e:
+                logger.warning(
+                    f"Could not query existing brokers, proceeding without validation: {str(e)}"
+                )
+                existing_broker_ids = None
+
+            # Keep only the last occurrence of each id: a repeated key in the
+            # same batch makes the whole upsert fail
+            keep = ~leads_df['id'].duplicated(keep='last').to_numpy()
+
+            if existing_broker_ids is not None and 'responsavel_id' in leads_df.columns:
+                broker_mask = self.existing_id_mask(leads_df['responsavel_id'],
+                                                    existing_broker_ids)
+                removed = int((keep & ~broker_mask).sum())
+                keep &= broker_mask
+                if removed:
+                    logger.warning(
+                        f"Filtered out {removed} leads with non-existent responsavel_ids"
+                    )
+
+            leads_df_clean = leads_df.take(np.flatnonzero(keep))
+
+            if leads_df_clean.empty:
+                logger.warning("No valid leads to insert after filtering")
+                return
+
+            leads_df_clean = self._sanitize_numeric(
+                leads_df_clean,
+                ['id', 'responsavel_id', 'status_id', 'pipeline_id'])
+
+            logger.info(f"Upserting {len(leads_df_clean)} leads to Supabase")
+
+            # One updated_at for the whole upsert and every datetime column
+            # converted to ISO in one vectorized pass
+            leads_df_clean['updated_at'] = datetime.now().isoformat()
+            leads_data = self._to_records(
+                self._datetimes_to_iso(leads_df_clean))
+
+            # Lotes paralelos, com novas tentativas por lote
+            results = self._upsert_chunked("leads",
+                                           leads_data,
+                                           on_conflict='id')
+
+            # Os leads enviados passam a existir: upsert_activities não
+            # precisa consultá-los de novo
+            self.remember_existing_ids("leads",
+                                       self.distinct_ids(leads_df_clean, 'id'))
+
+            logger.info(
+                f"Leads upserted successfully: {len(leads_data)} records processed"
+            )
+            return results
+
+        except Exception as e:
+            logger.error(f"Failed to upsert leads: {str(e)}")
+            raise
+
     def upsert_activities(self, activities_df):
         """
         Insert or update activity data in the Supabase database
@@ -441,19 +934,20 @@ class SupabaseClient:
 
             logger.info(f"Processing {len(activities_df)} activities")
 
-            # First, get a list of all lead_ids in the leads table
+            # Query only the lead and broker IDs used by these activities, both
+            # lookups at the same time (they are independent round-trips)
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                leads_future = executor.submit(
+                    self.select_existing_ids, "leads",
+                    self.distinct_ids(activities_df, 'lead_id'))
+                brokers_future = executor.submit(
+                    self.select_existing_ids, "brokers",
+                    self.distinct_ids(activities_df, 'user_id'))
+
+            # First, check which of the referenced lead_ids exist in the leads table
             try:
-                # Query existing lead IDs from the database to ensure we only insert activities for existing leads
-                leads_result = self.client.table("leads").select(
-                    "id").execute()
-                if hasattr(leads_result, "error") and leads_result.error:
-                    raise Exception(
-                        f"Supabase error querying leads: {leads_result.error}")
-
-                # Create a set of existing lead IDs for faster lookup
-                existing_lead_ids = set()
-                for lead in leads_result.data:
-                    existing_lead_ids.add(lead['id'])
+                # Ensures we only insert activities for existing leads
+                existing_lead_ids = leads_future.result()
 
                 logger.info(
                     f"Found {len(existing_lead_ids)} existing leads in database"
@@ -464,49 +958,10 @@ class SupabaseClient:
                 )
                 existing_lead_ids = None
 
-            # Make a copy of the DataFrame to avoid modifying the original
-            activities_df_clean = activities_df.copy()
-
-            # Replace infinite values with None (null in JSON)
-            numeric_cols = activities_df_clean.select_dtypes(
-                include=['float', 'int']).columns
-            for col in numeric_cols:
-                # Replace NaN and infinite values with None
-                mask = ~np.isfinite(activities_df_clean[col])
-                if mask.any():
-                    activities_df_clean.loc[mask, col] = None
-
-            # Convert bigint columns from float to int to avoid "invalid input syntax for type bigint" errors
-            bigint_columns = ['lead_id', 'user_id']
-            for col in bigint_columns:
-                if col in activities_df_clean.columns:
-                    # Only convert finite values (NaN/None will be handled separately)
-                    mask = np.isfinite(activities_df_clean[col])
-                    if mask.any():
-                        activities_df_clean.loc[mask,
-                                                col] = activities_df_clean.loc[
-                                                    mask, col].astype('Int64')
-
-            # The 'id' column in activities table is of type TEXT in SQL, but Kommo API might return it as a number
-            # We need to ensure it's converted to string
-            if 'id' in activities_df_clean.columns:
-                activities_df_clean['id'] = activities_df_clean['id'].astype(
-                    str)
-
-            # Get a list of all broker_ids in the brokers table
+            # Check which of the referenced broker_ids exist in the brokers table
             try:
-                # Query existing broker IDs from the database to ensure we only insert activities with valid user_ids
-                brokers_result = self.client.table("brokers").select(
-                    "id").execute()
-                if hasattr(brokers_result, "error") and brokers_result.error:
-                    raise Exception(
-                        f"Supabase error querying brokers: {brokers_result.error}"
-                    )
-
-                # Create a set of existing broker IDs for faster lookup
-                existing_broker_ids = set()
-                for broker in brokers_result.data:
-                    existing_broker_ids.add(broker['id'])
+                # Ensures we only insert activities with valid user_ids
+                existing_broker_ids = brokers_future.result()
 
                 logger.info(
                     f"Found {len(existing_broker_ids)} existing brokers in database"
@@ -518,83 +973,176 @@ class SupabaseClient:
                 existing_broker_ids = None
 
             # Filter activities to only include those with existing lead_ids and user_ids
-            filter_needed = False
+            keep = np.ones(len(activities_df), dtype=bool)
 
             # Filter by lead_id
-            if existing_lead_ids is not None and 'lead_id' in activities_df_clean.columns:
-                filter_needed = True
-                original_count = len(activities_df_clean)
-                activities_df_clean = activities_df_clean[
-                    activities_df_clean['lead_id'].isin(existing_lead_ids)
-                    | activities_df_clean['lead_id'].isna()]
-                filtered_count = len(activities_df_clean)
-                if filtered_count < original_count:
+            if existing_lead_ids is not None and 'lead_id' in activities_df.columns:
+                lead_mask = self.existing_id_mask(activities_df['lead_id'],
+                                                  existing_lead_ids)
+                removed = int((keep & ~lead_mask).sum())
+                keep &= lead_mask
+                if removed:
                     logger.warning(
-                        f"Filtered out {original_count - filtered_count} activities with non-existent lead_ids"
+                        f"Filtered out {removed} activities with non-existent lead_ids"
                     )
 
             # Filter by user_id
-            if existing_broker_ids is not None and 'user_id' in activities_df_clean.columns:
-                filter_needed = True
-                original_count = len(activities_df_clean)
-                activities_df_clean = activities_df_clean[
-                    activities_df_clean['user_id'].isin(existing_broker_ids)
-                    | activities_df_clean['user_id'].isna()]
-                filtered_count = len(activities_df_clean)
-                if filtered_count < original_count:
+            if existing_broker_ids is not None and 'user_id' in activities_df.columns:
+                user_mask = self.existing_id_mask(activities_df['user_id'],
+                                                  existing_broker_ids)
+                removed = int((keep & ~user_mask).sum())
+                keep &= user_mask
+                if removed:
                     logger.warning(
-                        f"Filtered out {original_count - filtered_count} activities with non-existent user_ids"
+                        f"Filtered out {removed} activities with non-existent user_ids"
                     )
 
-            # If we have no activities after filtering, exit early
+            # Keep only the last occurrence of each id: a repeated key in the
+            # same batch makes the whole upsert fail
+            if 'id' in activities_df.columns:
+                keep &= ~activities_df['id'].duplicated(keep='last').to_numpy()
+
+            # take() already returns a new, independent DataFrame, so the
+            # original is never modified and no extra copy() is needed
+            activities_df_clean = activities_df.take(np.flatnonzero(keep))
+
+            # If we have no activities after filtering, exit early, before
+            # any sanitizing or conversion work
             if activities_df_clean.empty:
                 logger.warning("No valid activities to insert after filtering")
                 return
 
+            # Replace NaN/infinite values with None (null in JSON) and convert bigint
+            # columns from float to int to avoid "invalid input syntax for type bigint" errors
+            bigint_columns = ['lead_id', 'user_id']
+            activities_df_clean = self._sanitize_numeric(
+                activities_df_clean, bigint_columns)
+
+            # The 'id' column in activities table is of type TEXT in SQL, but Kommo API might return it as a number
+            # We need to ensure it's converted to string
+            if 'id' in activities_df_clean.columns:
+                activities_df_clean['id'] = activities_df_clean['id'].astype(
+                    str)
+
             logger.info(
                 f"Upserting {len(activities_df_clean)} activities to Supabase")
 
-            # Convert DataFrame to list of dicts
-            activities_data = activities_df_clean.to_dict(orient="records")
-
-            # Add updated_at timestamp and convert datetime objects
-            for activity in activities_data:
-                activity["updated_at"] = datetime.now().isoformat()
-
-                # Convert datetime objects to ISO format
-                if "criado_em" in activity and activity[
-                        "criado_em"] is not None:
-                    activity["criado_em"] = activity["criado_em"].isoformat()
-
-                # Additional check for any remaining non-JSON compatible values and type conversions
-                for key, value in list(
-                        activity.items()
-                ):  # Create a list to avoid "dictionary changed size during iteration"
-                    # Check for NaN, Infinity, -Infinity in float values
-                    if isinstance(value, float) and (np.isnan(value)
-                                                     or np.isinf(value)):
-                        activity[key] = None
-                    # Convert float to int for bigint columns
-                    elif key in bigint_columns and isinstance(
-                            value, float) and value.is_integer():
-                        activity[key] = int(value)
+            # Add updated_at timestamp (same for the whole upsert) as a scalar
+            # column and convert datetime columns to ISO format in one
+            # vectorized pass, then the DataFrame to a list of dicts
+            activities_df_clean['updated_at'] = datetime.now().isoformat()
+            activities_data = self._to_records(
+                self._datetimes_to_iso(activities_df_clean, ['criado_em']))
 
             # Upsert data to Supabase - inserir novos e atualizar existentes
-            result = self.client.table("activities").upsert(
-                activities_data, on_conflict='id').execute()
-
-            if hasattr(result, "error") and result.error:
-                raise Exception(f"Supabase error: {result.error}")
+            results = self._upsert_chunked("activities",
+                                           activities_data,
+                                           on_conflict='id')
 
             logger.info(
                 f"Activities upserted successfully: {len(activities_data)} records processed"
             )
-            return result
+            return results
 
         except Exception as e:
             logger.error(f"Failed to upsert activities: {str(e)}")
             raise
 
+    def calculate_response_times(self, leads_df, notes_by_lead):
+        """
+        Calcula o tempo de resposta (segundos entre a criação do lead e a
+        primeira nota de um usuário) de todos os leads de uma vez, subtraindo
+        arrays int64 em nanossegundos em vez de datetimes lead a lead
+
+        Args:
+            leads_df (pandas.DataFrame): Leads com as colunas id e criado_em
+            notes_by_lead (dict): lead_id -> DataFrame de notas, como
+                retornado por KommoAPI.get_notes_for_leads
+
+        Returns:
+            numpy.ndarray: Tempo de resposta em segundos por lead (NaN quando
+                o lead não tem nota ou data de criação)
+        """
+        response_times = np.full(len(leads_df), np.nan)
+        notes = [
+            df[['lead_id', 'criado_em']] for df in notes_by_lead.values()
+            if not df.empty
+        ]
+        if not notes or leads_df.empty:
+            return response_times
+
+        # Primeira nota de cada lead; as datas das notas já vêm em UTC
+        # (KommoAPI._process_notes) e criado_em é convertido para UTC abaixo
+        first_note = (pd.concat(notes, ignore_index=True)
+                      .assign(criado_em=lambda df: pd.to_datetime(
+                          df['criado_em'], errors='coerce', utc=True))
+                      .groupby('lead_id')['criado_em'].min())
+
+        created_ns = pd.to_datetime(leads_df['criado_em'], errors='coerce',
+                                    utc=True).to_numpy(dtype='datetime64[ns]')
+        first_ns = pd.to_datetime(leads_df['id'].map(first_note), utc=True
+                                  ).to_numpy(dtype='datetime64[ns]')
+
+        valid = ~(np.isnat(created_ns) | np.isnat(first_ns))
+        response_times[valid] = (first_ns[valid].view(np.int64) -
+                                 created_ns[valid].view(np.int64)) * 1e-9
+        return response_times
+
+    @staticmethod
+    def _to_utc_datetimes(df, columns):
+        """
+        Converte as colunas informadas para datetime UTC (valores inválidos
+        viram NaT). Colunas que já são datetime UTC são mantidas; o DataFrame
+        só é copiado (via assign) se alguma coluna precisar de conversão
+
+        Args:
+            df (pandas.DataFrame): DataFrame de origem (não é alterado)
+            columns (tuple): Colunas de data
+
+        Returns:
+            pandas.DataFrame: DataFrame com as colunas convertidas
+        """
+        converted = {
+            col: pd.to_datetime(df[col], errors='coerce', utc=True)
+            for col in columns
+            if col in df.columns and not (
+                isinstance(df[col].dtype, pd.DatetimeTZDtype)
+                and str(df[col].dtype.tz) == 'UTC')
+        }
+        return df.assign(**converted) if converted else df
+
+    def _sanitize_numeric(self, df, bigint_columns=()):
+        """
+        Prepara as colunas numéricas do DataFrame para serialização JSON
+
+        Substitui NaN/Inf por None em todas as colunas numéricas de uma vez e
+        converte as colunas bigint para int, sem percorrer os registros em Python.
+
+        Args:
+            df (pandas.DataFrame): DataFrame a ser tratado (modificado in-place)
+            bigint_columns (list): Colunas que devem ser enviadas como inteiros
+
+        Returns:
+            pandas.DataFrame: O mesmo DataFrame, com as colunas tratadas
+        """
+        # Colunas bigint primeiro, todas de uma vez via Int64 (nullable);
+        # viram object e ficam fora do tratamento numérico abaixo
+        bigint_cols = [col for col in bigint_columns if col in df.columns]
+        if bigint_cols:
+            values = df[bigint_cols].apply(pd.to_numeric, errors='coerce')
+            values = values.where(
+                np.isfinite(values.to_numpy(dtype=float, na_value=np.nan)))
+            ints = values.astype('Int64')
+            df[bigint_cols] = ints.astype(object).where(ints.notna(), None)
+
+        numeric_cols = df.select_dtypes(include=[np.number]).columns
+        if len(numeric_cols) > 0:
+            values = df[numeric_cols]
+            finite = np.isfinite(values.to_numpy(dtype=float))
+            df[numeric_cols] = values.astype(object).where(finite, None)
+
+        return df
+
     def get_broker_points(self):
         """
         Retrieve broker points from the Supabase database
@@ -623,11 +1171,6 @@ class SupabaseClient:
         Args:
             points_df (pandas.DataFrame): DataFrame contendo os dados de pontuação dos corretores.
         """
-        import numpy as np
-        import logging
-
-        logger = logging.getLogger(__name__)
-
         try:
             if points_df.empty:
                 logger.warning("Nenhum dado de pontos para inserir.")
@@ -638,78 +1181,32 @@ class SupabaseClient:
                 logger.error("DataFrame não contém a coluna company_id")
                 return
 
-            # Filtra registros por company_id
-            unique_companies = points_df['company_id'].unique()
-            all_responses = []
+            if 'id' not in points_df.columns:
+                logger.error("DataFrame não contém a coluna id")
+                return
 
-            for company_id in unique_companies:
-                company_df = points_df[points_df['company_id'] ==
-                                       company_id].copy()
+            # Registros sem id não podem ser identificados no upsert, e ids
+            # repetidos no mesmo lote fazem o upsert falhar (fica o último).
+            # take() devolve um DataFrame novo, então o original não é alterado
+            keep = (points_df['id'].notna()
+                    & ~points_df['id'].duplicated(keep='last')).to_numpy()
+            points_df = points_df.take(np.flatnonzero(keep))
 
-                logger.info(
-                    f"Upsert de {len(company_df)} registros na tabela broker_points para company_id {company_id}."
-                )
+            logger.info(
+                f"Upsert de {len(points_df)} registros na tabela broker_points para {points_df['company_id'].nunique()} empresa(s)."
+            )
 
-                # Trata valores infinitos ou inválidos
-                numeric_cols = company_df.select_dtypes(
-                    include=['float', 'int']).columns
-                for col in numeric_cols:
-                    mask = ~np.isfinite(company_df[col])
-                    if mask.any():
-                        company_df.loc[mask, col] = None
-
-                # Realiza o upsert na tabela broker_points
-                records = company_df.to_dict("records")
-                for record in records:
-                    for key, value in record.items():
-                        if isinstance(value, pd.Timestamp):
-                            record[key] = value.isoformat()
-
-                # Verifica se os registros já existem e faz update ou insert
-                for record in records:
-                    broker_id = record.get('id')
-                    if broker_id:
-                        try:
-                            # Verifica se o registro já existe
-                            existing = self.client.table(
-                                "broker_points").select("id").eq(
-                                    "id",
-                                    broker_id).eq("company_id",
-                                                  company_id).execute()
-
-                            if existing.data:
-                                # Update se existe - remove campos que não devem ser atualizados na condição
-                                update_record = {
-                                    k: v
-                                    for k, v in record.items()
-                                    if k not in ['id', 'company_id']
-                                }
-                                response = self.client.table(
-                                    "broker_points").update(update_record).eq(
-                                        "id",
-                                        broker_id).eq("company_id",
-                                                      company_id).execute()
-                            else:
-                                # Insert se não existe
-                                response = self.client.table(
-                                    "broker_points").insert(record).execute()
-
-                            if hasattr(response, "error") and response.error:
-                                logger.error(
-                                    f"Error updating broker points: {response.error}"
-                                )
-                                raise Exception(
-                                    f"Error updating broker points: {response.error}"
-                                )
+            # Trata valores infinitos ou inválidos
+            points_df = self._sanitize_numeric(points_df)
 
-                            all_responses.append(response)
-                        except Exception as individual_error:
-                            logger.warning(
-                                f"Error processing record for broker {broker_id}: {individual_error}"
-                            )
-                            continue
+            # Datas em ISO 8601 de forma vetorizada, coluna a coluna
+            records = self._to_records(self._datetimes_to_iso(points_df))
 
-            return all_responses
+            # Todas as empresas vão nos mesmos lotes, em vez de um select +
+            # update/insert por registro; ids que pertencem a outra empresa
+            # ficam de fora e um registro com erro não derruba o lote
+            return self._save_broker_points(
+                self._without_foreign_broker_points(records))
 
         except Exception as e:
             logger.error(f"Erro ao fazer upsert em broker_points: {e}")
@@ -893,13 +1390,119 @@ class SupabaseClient:
                 f"Erro ao buscar mensagens do lead {lead_id}: {str(e)}")
             return []
 
+    def get_messages_for_brokers(self, broker_ids, limit_per_broker=50):
+        """
+        Busca as mensagens de vários brokers em uma única chamada
+
+        Args:
+            broker_ids (list): IDs dos brokers
+            limit_per_broker (int): Limite de mensagens por broker
+
+        Returns:
+            dict: broker_id -> lista de mensagens (mais recentes primeiro)
+        """
+        return self._get_latest_messages("broker_id",
+                                         "webhook_messages_top_n_by_broker",
+                                         broker_ids, limit_per_broker,
+                                         self.get_broker_messages)
+
+    def get_messages_for_leads(self, lead_ids, limit_per_lead=50):
+        """
+        Busca as mensagens de vários leads em uma única chamada
+
+        Args:
+            lead_ids (list): IDs dos leads
+            limit_per_lead (int): Limite de mensagens por lead
+
+        Returns:
+            dict: lead_id -> lista de mensagens (mais recentes primeiro)
+        """
+        return self._get_latest_messages("lead_id",
+                                         "webhook_messages_top_n_by_lead",
+                                         lead_ids, limit_per_lead,
+                                         self.get_lead_messages)
+
+    def _get_latest_messages(self, column, function, ids, limit, fallback):
+        """
+        Últimas mensagens de cada id via a função SQL informada
+        (webhook_messages_functions.sql), agrupadas por id. Os ids vão em
+        lotes de POSTGREST_MAX_ROWS // limit, para que nenhuma resposta seja
+        truncada pelo max-rows do PostgREST. Só se a função não estiver
+        instalada busca id a id com fallback
+
+        Args:
+            column (str): Coluna de from_webhook usada no agrupamento
+            function (str): Nome da função SQL
+            ids (list): Ids a buscar
+            limit (int): Limite de mensagens por id (no máximo
+                POSTGREST_MAX_ROWS)
+            fallback (callable): Busca de um único id (id, limit) -> list
+
+        Returns:
+            dict: id -> lista de mensagens ({} se a consulta falhar)
+        """
+        # broker_id e lead_id são TEXT em from_webhook
+        keys = {str(i): i for i in ids}
+        if not keys:
+            return {}
+
+        limit = min(limit, POSTGREST_MAX_ROWS)
+        ids_per_call = max(1, POSTGREST_MAX_ROWS // limit)
+        key_list = list(keys)
+
+        messages = {i: [] for i in keys.values()}
+        for start in range(0, len(key_list), ids_per_call):
+            try:
+                result = self.client.rpc(function, {
+                    "p_ids": key_list[start:start + ids_per_call],
+                    "p_limit": limit
+                }).execute()
+            except APIError as e:
+                if e.code not in MISSING_FUNCTION_ERROR_CODES:
+                    logger.error(
+                        f"Erro ao buscar mensagens via {function}: {str(e)}")
+                    return {}
+                logger.warning(
+                    f"Função {function} indisponível, buscando mensagens uma a uma: {str(e)}"
+                )
+                return {i: fallback(i, limit) for i in keys.values()}
+            except Exception as e:
+                logger.error(
+                    f"Erro ao buscar mensagens via {function}: {str(e)}")
+                return {}
+
+            for row in result.data or []:
+                key = keys.get(str(row.get(column)))
+                if key is not None:
+                    messages[key].append(row)
+        return messages
+
     def initialize_broker_points(self, company_id=None):
         """
         Cria registros na tabela broker_points para todos os corretores cadastrados,
-        com os campos de pontuação zerados. Evita duplicações verificando existência.
+        com os campos de pontuação zerados. Registros existentes não são alterados.
+
+        Usa a função initialize_broker_points_for_company
+        (initialize_broker_points_function.sql), que faz tudo em uma chamada;
+        se ela não estiver instalada, busca os corretores e insere com
+        ON CONFLICT DO NOTHING.
         """
         company_id = company_id or self.kommo_config.get('company_id')
         try:
+            try:
+                result = self.client.rpc(
+                    "initialize_broker_points_for_company", {
+                        "p_company_id": company_id
+                    }).execute()
+                logger.info(
+                    f"Broker points inicializados para {result.data or 0} corretores."
+                )
+                return True
+            except Exception as e:
+                logger.warning(
+                    f"Função initialize_broker_points_for_company indisponível, inicializando pelo cliente: {str(e)}"
+                )
+
             # Buscar corretores com cargo "Corretor" e company_id específico
             brokers_result = self.client.table("brokers").select(
                 "id, nome").eq("cargo", "Corretor").eq("company_id",
@@ -915,55 +1518,31 @@ class SupabaseClient:
                 )
                 return
 
-            # Buscar registros existentes para evitar duplicatas
-            existing_result = self.client.table("broker_points").select(
-                "id").eq("company_id", company_id).execute()
+            # Criar registros com pontuação zero e company_id (um por id)
+            new_df = pd.DataFrame(list({b['id']: b for b in brokers}.values()),
+                                  columns=["id", "nome"])
+            new_df = new_df.assign(
+                company_id=company_id,
+                **dict.fromkeys(BROKER_POINTS_ZERO_COLUMNS, 0),
+                updated_at=datetime.now().isoformat())
+            new_records = self._to_records(new_df)
+
+            # ON CONFLICT DO NOTHING: quem já tem registro fica como está, sem
+            # precisar consultar os ids existentes antes
+            result = self.client.table("broker_points").upsert(
+                new_records,
+                on_conflict='id',
+                ignore_duplicates=True,
+                returning=ReturnMethod.minimal).execute()
 
-            existing_ids = set()
-            if existing_result.data:
-                existing_ids = {
-                    record['id']
-                    for record in existing_result.data
-                }
-
-            # Filtrar apenas corretores que não têm registros
-            brokers_to_insert = [
-                b for b in brokers if b['id'] not in existing_ids
-            ]
-
-            if not brokers_to_insert:
-                logger.info(
-                    f"Todos os corretores já têm registros em broker_points para company_id {company_id}"
-                )
-                return True
-
-            # Criar registros com pontuação zero e company_id (apenas campos do novo schema)
-            now = datetime.now().isoformat()
-            new_records = [{
-                "id": b["id"],
-                "company_id": company_id,
-                "nome": b["nome"],
-                "leads_visitados": 0,
-                "propostas_enviadas": 0,
-                "vendas_realizadas": 0,
-                "leads_perdidos": 0,
-                "pontos": 0,
-                "updated_at": now
-            } for b in brokers_to_insert]
-
-            # Inserir registros novos
-            if new_records:
-                result = self.client.table("broker_points").insert(
-                    new_records).execute()
-
-                if hasattr(result, "error") and result.error:
-                    logger.error(
-                        f"Erro ao inserir broker_points: {result.error}")
-                    return False
+            if hasattr(result, "error") and result.error:
+                logger.error(
+                    f"Erro ao inserir broker_points: {result.error}")
+                return False
 
-                logger.info(
-                    f"Broker points inicializados para {len(new_records)} corretores."
-                )
+            logger.info(
+                f"Broker points inicializados para {len(new_records)} corretores (existentes ignorados)."
+            )
             return True
 
         except Exception as e:
@@ -1020,9 +1599,6 @@ class SupabaseClient:
             except Exception as inner_e:
                 logger.error(f"Erro ao buscar filtro de datas: {inner_e}")
 
-            from datetime import datetime, timedelta
-            import pytz
-
             sao_paulo_tz = pytz.timezone('America/Sao_Paulo')
             now = datetime.now(sao_paulo_tz)
 
@@ -1082,6 +1658,11 @@ class SupabaseClient:
                     ]
                     logger.info(f"Filtered activities to {len(activities)} records within date range")
 
+            # Converte as datas uma única vez aqui, e não nos DataFrames de cada
+            # corretor a cada regra em _calculate_rule_points
+            leads = self._to_utc_datetimes(leads, ('criado_em', 'atualizado_em'))
+            activities = self._to_utc_datetimes(activities, ('criado_em',))
+
             # Load current rules for this company
             rules = self.load_rules(company_id)
             if not rules:
@@ -1091,18 +1672,37 @@ class SupabaseClient:
             existing_points = self.client.table("broker_points").select("*").eq("company_id", company_id).execute()
             points_dict = {point['id']: point for point in existing_points.data}
 
-            for _, broker in brokers.iterrows():
+            # Mesmo updated_at para todos os corretores desta execução
+            current_time = datetime.now().isoformat()
+
+            # Particiona leads e atividades por corretor em uma única passada
+            # (groupby), em vez de uma máscara sobre o DataFrame inteiro a cada
+            # corretor
+            leads_by_broker = dict(tuple(
+                leads.groupby('responsavel_id', sort=False))) if not leads.empty else {}
+            activities_by_broker = dict(tuple(
+                activities.groupby('user_id', sort=False))) if not activities.empty else {}
+            no_leads = leads.iloc[0:0]
+            no_activities = activities.iloc[0:0]
+
+            # Registros alterados e novos, gravados juntos ao final
+            changed_rows = []
+            new_rows = []
+
+            # Dicts por linha em vez de iterrows(), que cria uma Series por corretor
+            for broker in self._to_records(brokers):
                 broker_id = broker['id']
                 broker_name = broker.get('nome', 'Unknown')
                 total_points = 0
                 rule_results = {}
 
-                broker_leads = leads[leads['responsavel_id'] == broker_id] if not leads.empty else pd.DataFrame()
-                broker_activities = activities[activities['user_id'] == broker_id] if not activities.empty else pd.DataFrame()
+                broker_leads = leads_by_broker.get(broker_id, no_leads)
+                broker_activities = activities_by_broker.get(broker_id, no_activities)
 
-                logger.info(f"Calculating points for broker {broker_name} (ID: {broker_id})")
-                logger.info(f"  - {len(broker_leads)} leads")
-                logger.info(f"  - {len(broker_activities)} activities")
+                logger.info(
+                    f"Calculating points for broker {broker_name} (ID: {broker_id}): "
+                    f"{len(broker_leads)} leads, {len(broker_activities)} activities"
+                )
 
                 for rule_name, rule_config in rules.items():
                     try:
@@ -1122,13 +1722,11 @@ class SupabaseClient:
                         logger.error(f"Error calculating rule {rule_name} for broker {broker_id}: {str(e)}")
                         rule_results[rule_name] = 0
 
-                current_time = datetime.now().isoformat()
                 broker_points_data = {
                     'id': broker_id,
                     'company_id': company_id,
                     'pontos': total_points,
-                    'nome': broker_name,
-                    'updated_at': current_time
+                    'nome': broker_name
                 }
 
                 schema_fields = ['leads_visitados', 'propostas_enviadas', 'vendas_realizadas', 'leads_perdidos']
@@ -1136,51 +1734,35 @@ class SupabaseClient:
                     if rule_name in schema_fields:
                         broker_points_data[rule_name] = count
 
-                try:
-                    existing_check = self.client.table("broker_points").select("*").eq(
-                        "id", broker_id
-                    ).eq("company_id", company_id).execute()
-
-                    if existing_check.data:
-                        existing_data = existing_check.data[0]
-                        update_data = {}
-
-                        for key, new_value in broker_points_data.items():
-                            if key in ['id', 'company_id']:
-                                continue
-
-                            existing_value = existing_data.get(key)
-                            if existing_value != new_value:
-                                if isinstance(existing_value, (int, float)) and isinstance(new_value, (int, float)):
-                                    if existing_value != new_value:
-                                        update_data[key] = new_value
-                                else:
-                                    update_data[key] = new_value
-
-                        if update_data:
-                            result = self.client.table("broker_points").update(update_data).eq(
-                                "id", broker_id
-                            ).eq("company_id", company_id).execute()
-
-                            if hasattr(result, "error") and result.error:
-                                logger.error(f"Update error for broker {broker_id}: {result.error}")
-                                continue
+                # Compara com o registro já carregado em points_dict, em vez
+                # de um select por corretor; updated_at fica fora da comparação
+                # e só é gravado nos registros que mudaram
+                existing_data = points_dict.get(broker_id)
+                if existing_data is None:
+                    new_rows.append({**broker_points_data, 'updated_at': current_time})
+                    continue
 
-                            logger.info(f"Updated {len(update_data)} fields for {broker_name}: {total_points} total points")
-                        else:
-                            logger.info(f"No changes detected for {broker_name} - skipping update")
-                    else:
-                        result = self.client.table("broker_points").insert(broker_points_data).execute()
+                update_data = {
+                    key: new_value
+                    for key, new_value in broker_points_data.items()
+                    if key not in ('id', 'company_id')
+                    and existing_data.get(key) != new_value
+                }
 
-                        if hasattr(result, "error") and result.error:
-                            logger.error(f"Insert error for broker {broker_id}: {result.error}")
-                            continue
+                if update_data:
+                    changed_rows.append({**broker_points_data, 'updated_at': current_time})
+                    logger.info(f"Updated {len(update_data)} fields for {broker_name}: {total_points} total points")
+                else:
+                    logger.info(f"No changes detected for {broker_name} - skipping update")
 
-                        logger.info(f"Inserted new record for {broker_name}: {total_points} total points")
+            # Corretores sem registro nesta empresa: o upsert por id não pode
+            # sobrescrever um registro com o mesmo id de outra empresa
+            for row in self._without_foreign_broker_points(new_rows):
+                changed_rows.append(row)
+                logger.info(f"New record for {row['nome']}: {row['pontos']} total points")
 
-                except Exception as db_error:
-                    logger.error(f"Database error for broker {broker_id}: {str(db_error)}")
-                    continue
+            if changed_rows:
+                self._save_broker_points(changed_rows)
 
             logger.info("Broker points calculation completed successfully")
             
@@ -1191,6 +1773,77 @@ class SupabaseClient:
             logger.error(f"Error updating broker points: {str(e)}")
             return
 
+    def _without_foreign_broker_points(self, rows):
+        """
+        Remove os registros cujo id já existe em broker_points sob outra
+        empresa (company_id diferente do da linha): o upsert por id
+        sobrescreveria o registro da outra empresa
+
+        Args:
+            rows (list): Registros de broker_points com id e company_id
+
+        Returns:
+            list: Registros que podem ser gravados
+        """
+        if not rows:
+            return []
+
+        company_by_id = {row['id']: row.get('company_id') for row in rows}
+        ids = list(company_by_id)
+        try:
+            foreign_ids = set()
+            for start in range(0, len(ids), IN_FILTER_CHUNK_SIZE):
+                result = self.client.table("broker_points").select(
+                    "id, company_id").in_(
+                        "id", ids[start:start + IN_FILTER_CHUNK_SIZE]).execute()
+                foreign_ids.update(
+                    row['id'] for row in result.data or ()
+                    if row.get('company_id') != company_by_id.get(row['id']))
+        except Exception as e:
+            logger.error(f"Error checking broker_points of other companies: {str(e)}")
+            return []
+
+        for broker_id in foreign_ids:
+            logger.error(
+                f"Broker {broker_id} already has broker_points under another company - skipping"
+            )
+        return [row for row in rows if row['id'] not in foreign_ids]
+
+    def _save_broker_points(self, rows):
+        """
+        Grava os registros de broker_points em lotes; se um lote falhar,
+        grava seus registros um a um para que só os corretores com erro
+        fiquem sem pontuação
+
+        Args:
+            rows (list): Registros de broker_points (mesmas colunas)
+
+        Returns:
+            int: Quantidade de registros gravados
+        """
+        chunk_size = UPSERT_CHUNK_SIZES.get("broker_points", UPSERT_CHUNK_SIZE)
+        saved = 0
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            try:
+                self._upsert_chunked("broker_points", chunk, on_conflict='id')
+                saved += len(chunk)
+                continue
+            except Exception as e:
+                logger.error(
+                    f"Error saving broker_points for brokers {[row['id'] for row in chunk]}, "
+                    f"retrying one by one: {str(e)}")
+
+            for row in chunk:
+                try:
+                    self._upsert_chunked("broker_points", [row], on_conflict='id')
+                    saved += 1
+                except Exception as e:
+                    logger.error(f"Database error for broker {row['id']}: {str(e)}")
+
+        logger.info(f"Saved {saved} of {len(rows)} broker_points records")
+        return saved
+
     def setup_company_rules(self, company_id, default_rules=None):
         """
         Setup default rules for a company if they don't exist
@@ -1230,6 +1883,7 @@ class SupabaseClient:
                 if hasattr(result, "error") and result.error:
                     raise Exception(
                         f"Error creating default rules: {result.error}")
+                self._rules_cache.pop(company_id, None)
 
                 logger.info(
                     f"Created {len(rules_to_insert)} default rules for company {company_id}"
@@ -1321,9 +1975,6 @@ class SupabaseClient:
                     filter_data = filter_result.data[0]
                     filter_type = filter_data.get('filter_type')
                     
-                    from datetime import datetime, timedelta
-                    import pytz
-                    
                     sao_paulo_tz = pytz.timezone('America/Sao_Paulo')
                     now = datetime.now(sao_paulo_tz)
                     
@@ -1369,6 +2020,9 @@ class SupabaseClient:
                     ]
                     logger.info(f"Filtered leads to {len(all_leads)} records within date range")
             
+            # Mesmo timestamp para todas as métricas deste cálculo
+            current_time = datetime.now().isoformat()
+
             # Calcular cada métrica dinâmica
             for metric in dynamic_metrics:
                 try:
@@ -1390,8 +2044,6 @@ class SupabaseClient:
                     logger.info(f"Metric {metric_id}: {leads_count} leads reached stage {pipeline_stage_id}, target: {valor_minimo}, achieved: {atingiu_meta}")
                     
                     # Preparar dados para salvar
-                    current_time = datetime.now().isoformat()
-                    
                     # Usar periodo_referencia se disponível na tabela de filtros
                     periodo_referencia = "periodo_atual"
                     if date_filter_start and date_filter_end:
@@ -1457,27 +2109,17 @@ class SupabaseClient:
                                company_id):
         """Calculate count for a specific rule - returns the number of occurrences, not points"""
         try:
-            # Ensure datetime columns are properly converted with better error handling
+            # Ensure datetime columns are properly converted with better error handling.
+            # update_broker_points already converts them, so this only copies
+            # the frames when called with unconverted data
             try:
-                if not broker_activities.empty and 'criado_em' in broker_activities.columns:
-                    broker_activities = broker_activities.copy()
-                    broker_activities.loc[:, 'criado_em'] = pd.to_datetime(
-                        broker_activities['criado_em'],
-                        errors='coerce',
-                        utc=True)
+                if not broker_activities.empty:
+                    broker_activities = self._to_utc_datetimes(
+                        broker_activities, ('criado_em',))
 
                 if not broker_leads.empty:
-                    broker_leads = broker_leads.copy()
-                    if 'criado_em' in broker_leads.columns:
-                        broker_leads.loc[:, 'criado_em'] = pd.to_datetime(
-                            broker_leads['criado_em'],
-                            errors='coerce',
-                            utc=True)
-                    if 'atualizado_em' in broker_leads.columns:
-                        broker_leads.loc[:, 'atualizado_em'] = pd.to_datetime(
-                            broker_leads['atualizado_em'],
-                            errors='coerce',
-                            utc=True)
+                    broker_leads = self._to_utc_datetimes(
+                        broker_leads, ('criado_em', 'atualizado_em'))
             except Exception as date_error:
                 logger.warning(
                     f"Error converting datetime columns in rule {rule_name}: {date_error}"
@@ -1,10 +1,11 @@
 import logging
 import hashlib
 import json
-import time
 from datetime import datetime, timedelta
 from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
+from postgrest.types import ReturnMethod
 
 logger = logging.getLogger(__name__)
 
@@ -24,8 +25,10 @@ class SyncManager:
 
     def _generate_hash(self, data: Dict) -> str:
         """Generate a hash for data comparison"""
+        # Compact separators: less text to build and hash per record
         return hashlib.md5(json.dumps(data,
-                                      sort_keys=True).encode()).hexdigest()
+                                      sort_keys=True,
+                                      separators=(',', ':')).encode()).hexdigest()
 
     def _get_existing_records(self, table: str) -> Dict:
         """Get existing records from database with their hashes"""
@@ -34,19 +37,42 @@ class SyncManager:
             if hasattr(result, "error") and result.error:
                 raise Exception(f"Supabase error: {result.error}")
 
-            existing = {}
-            for record in result.data:
-                record_id = record['id']
-                existing[record_id] = {
+            return {
+                record['id']: {
                     'hash': self._generate_hash(record),
                     'data': record
                 }
-            return existing
+                for record in result.data
+            }
         except Exception as e:
             logger.error(
                 f"Error fetching existing records for {table}: {str(e)}")
             raise
 
+    def _valid_broker_ids(self, leads, activities, company_id) -> set:
+        """Ids de brokers da empresa referenciados pelos leads (responsavel_id)
+        e pelas atividades (user_id). Usa o cache de ids por empresa do
+        SupabaseClient (os brokers gravados neste sync já estão nele), em vez
+        de listar todos os brokers da empresa a cada execução"""
+        ids = set()
+        if isinstance(leads, pd.DataFrame):
+            ids.update(self.supabase.distinct_ids(leads, 'responsavel_id'))
+        if isinstance(activities, pd.DataFrame):
+            ids.update(self.supabase.distinct_ids(activities, 'user_id'))
+        return self.supabase.select_existing_ids("brokers", list(ids),
+                                                 company_id=company_id)
+
+    def _remember_company_ids(self, table: str, company_by_id: Dict) -> None:
+        """Registra no cache de ids do SupabaseClient, separados por empresa,
+        os ids do lote (gravados ou já existentes e inalterados). Registros
+        sem company_id não entram no cache"""
+        ids_by_company = {}
+        for record_id, company_id in company_by_id.items():
+            if company_id:
+                ids_by_company.setdefault(company_id, []).append(record_id)
+        for company_id, ids in ids_by_company.items():
+            self.supabase.remember_existing_ids(table, ids, company_id)
+
     def _record_exists(self, table: str, record_id: str, existing_records: Dict) -> bool:
         """Verificar se um registro já existe na base de dados"""
         return record_id in existing_records
@@ -96,6 +122,8 @@ class SyncManager:
         try:
             to_upsert = []
             processed_ids = set()  # Track processed IDs to avoid duplicates
+            company_by_id = {}  # id -> company_id, para o cache de ids
+            now_iso = datetime.now().isoformat()
 
             for record in records:
                 processed = self._prepare_record(record)
@@ -107,6 +135,7 @@ class SyncManager:
                     continue
 
                 processed_ids.add(record_id)
+                company_by_id[record_id] = processed.get('company_id')
                 new_hash = self._generate_hash(processed)
 
                 # Skip if record hasn't changed
@@ -114,7 +143,7 @@ class SyncManager:
                         record_id]['hash'] == new_hash:
                     continue
 
-                processed['updated_at'] = datetime.now().isoformat()
+                processed['updated_at'] = now_iso
                 to_upsert.append(processed)
 
             if to_upsert:
@@ -132,7 +161,8 @@ class SyncManager:
                 if final_records:
                     # Usar upsert com merge duplicates para garantir inserção e atualização
                     result = self.supabase.client.table(table).upsert(
-                        final_records, on_conflict='id').execute()
+                        final_records, on_conflict='id',
+                        returning=ReturnMethod.minimal).execute()
                     if hasattr(result, "error") and result.error:
                         raise Exception(f"Supabase error: {result.error}")
 
@@ -142,18 +172,25 @@ class SyncManager:
 
                     logger.info(f"Processed {len(final_records)} records for {table}: {new_records} new, {updated_records} updated")
 
+            # Todos os ids do lote existem agora (inalterados ou gravados acima):
+            # a validação das atividades não precisa consultá-los de novo
+            self._remember_company_ids(table, company_by_id)
+
         except Exception as e:
             logger.error(f"Error processing batch for {table}: {str(e)}")
             raise
 
     def get_safe_batch_size(self, data_type):
         """Get safe batch size based on data type to prevent overload"""
+        # Cada lote vira uma única requisição de upsert ao PostgREST: lotes
+        # de ~1000 registros amortizam a latência sem chegar aos limites de
+        # tamanho do corpo da requisição
         batch_sizes = {
-            'brokers': 50,     # Reduzido para sincronização contínua
-            'leads': 100,      # Reduzido para melhor performance
-            'activities': 75   # Reduzido para evitar sobrecarga
+            'brokers': 500,
+            'leads': 1000,
+            'activities': 1000
         }
-        return batch_sizes.get(data_type, 50)
+        return batch_sizes.get(data_type, 500)
 
     def create_data_snapshot(self, company_id, snapshot_type="manual"):
         """Create a snapshot of current data for archival purposes"""
@@ -169,13 +206,14 @@ class SyncManager:
             total_leads = len(leads_result.data)
 
             # Store in data_snapshots table
+            now_iso = datetime.now().isoformat()
             self.supabase.client.table("data_snapshots").insert({
-                "snapshot_date": datetime.now().isoformat(),
+                "snapshot_date": now_iso,
                 "company_id": company_id,
                 "total_leads": total_leads,
                 "total_points": total_points,
                 "snapshot_type": snapshot_type,
-                "created_at": datetime.now().isoformat()
+                "created_at": now_iso
             }).execute()
 
             logger.info(
@@ -214,8 +252,6 @@ class SyncManager:
                     batch_changes = self._process_batch_incremental(batch, 'brokers', existing_brokers)
                     if batch_changes:
                         changes_found = True
-                    # Small delay between batches for continuous sync
-                    time.sleep(0.1)
 
                 changes_detected['brokers'] = changes_found
                 if changes_found:
@@ -224,25 +260,22 @@ class SyncManager:
 
             # Obter IDs válidos de brokers ANTES de processar leads
             try:
-                broker_ids = self.supabase.client.table("brokers").select("id").eq("company_id", company_id).execute()
-                valid_broker_ids = {item['id'] for item in broker_ids.data} if broker_ids.data else set()
+                valid_broker_ids = self._valid_broker_ids(leads, activities, company_id)
                 logger.info(f"Found {len(valid_broker_ids)} valid broker IDs for company {company_id}")
             except Exception as e:
                 logger.error(f"Error getting valid broker IDs: {e}")
-                valid_broker_ids = set()
+                valid_broker_ids = None
 
             # Processar Leads com validação de foreign key
             if isinstance(leads, pd.DataFrame) and not leads.empty:
                 # Filtrar leads apenas com responsavel_id válido
                 original_count = len(leads)
                 if valid_broker_ids:
-                    leads_filtered = leads[
-                        leads['responsavel_id'].isin(valid_broker_ids) | 
-                        leads['responsavel_id'].isna()
-                    ].copy()
+                    leads_filtered = leads[self.supabase.existing_id_mask(
+                        leads['responsavel_id'], valid_broker_ids)]
                 else:
                     # Se não há brokers, só manter leads sem responsavel_id
-                    leads_filtered = leads[leads['responsavel_id'].isna()].copy()
+                    leads_filtered = leads[leads['responsavel_id'].isna()]
 
                 filtered_count = len(leads_filtered)
                 if filtered_count < original_count:
@@ -257,8 +290,6 @@ class SyncManager:
                         batch_changes = self._process_batch_incremental(batch, 'leads', existing_leads)
                         if batch_changes:
                             changes_found = True
-                        # Small delay between batches for continuous sync
-                        time.sleep(0.1)
 
                     changes_detected['leads'] = changes_found
                     if changes_found:
@@ -269,16 +300,20 @@ class SyncManager:
             # Processar Activities
             if isinstance(activities, pd.DataFrame) and not activities.empty:
                 # Filtrar por IDs válidos
-                broker_ids = self.supabase.client.table("brokers").select("id").eq("company_id", company_id).execute()
-                valid_broker_ids = {item['id'] for item in broker_ids.data} if broker_ids.data else set()
-
-                lead_ids = self.supabase.client.table("leads").select("id").eq("company_id", company_id).execute()
-                valid_lead_ids = {item['id'] for item in lead_ids.data} if lead_ids.data else set()
-
-                filtered_activities = activities[(
-                    (activities['lead_id'].isin(valid_lead_ids) | activities['lead_id'].isna()) &
-                    (activities['user_id'].isin(valid_broker_ids) | activities['user_id'].isna())
-                )].copy()
+                # Brokers não mudam durante o processamento dos leads: reaproveita
+                # os ids já buscados e só consulta de novo se a busca falhou
+                if valid_broker_ids is None:
+                    valid_broker_ids = self._valid_broker_ids(leads, activities, company_id)
+                # Só os leads da empresa referenciados pelas atividades, via
+                # in_(), em vez de todos os ids de leads da empresa
+                valid_lead_ids = self.supabase.select_existing_ids(
+                    "leads", self.supabase.distinct_ids(activities, 'lead_id'),
+                    company_id=company_id)
+
+                filtered_activities = activities[
+                    self.supabase.existing_id_mask(activities['lead_id'], valid_lead_ids) &
+                    self.supabase.existing_id_mask(activities['user_id'], valid_broker_ids)
+                ]
 
                 if not filtered_activities.empty:
                     existing_activities = self._get_existing_records('activities')
@@ -289,8 +324,6 @@ class SyncManager:
                         batch_changes = self._process_batch_incremental(batch, 'activities', existing_activities)
                         if batch_changes:
                             changes_found = True
-                        # Small delay between batches for continuous sync
-                        time.sleep(0.15)
 
                     changes_detected['activities'] = changes_found
                     if changes_found:
@@ -319,6 +352,8 @@ class SyncManager:
             to_upsert = []
             changes_found = False
             processed_ids = set()  # Track processed IDs to avoid duplicates
+            company_by_id = {}  # id -> company_id, para o cache de ids
+            now_iso = datetime.now().isoformat()
 
             for record in records:
                 processed = self._prepare_record(record)
@@ -330,18 +365,19 @@ class SyncManager:
                     continue
 
                 processed_ids.add(record_id)
+                company_by_id[record_id] = processed.get('company_id')
                 new_hash = self._generate_hash(processed)
 
                 # Verificar se o registro mudou
                 if record_id in existing_records:
                     if existing_records[record_id]['hash'] != new_hash:
-                        processed['updated_at'] = datetime.now().isoformat()
+                        processed['updated_at'] = now_iso
                         to_upsert.append(processed)
                         changes_found = True
                         logger.debug(f"Change detected in {table} record ID: {record_id}")
                 else:
                     # Novo registro
-                    processed['updated_at'] = datetime.now().isoformat()
+                    processed['updated_at'] = now_iso
                     to_upsert.append(processed)
                     changes_found = True
                     logger.debug(f"New record in {table} ID: {record_id}")
@@ -361,7 +397,8 @@ class SyncManager:
                 if final_records:
                     # Usar upsert com merge duplicates para garantir inserção e atualização
                     result = self.supabase.client.table(table).upsert(
-                        final_records, on_conflict='id').execute()
+                        final_records, on_conflict='id',
+                        returning=ReturnMethod.minimal).execute()
                     if hasattr(result, "error") and result.error:
                         raise Exception(f"Supabase error: {result.error}")
 
@@ -371,6 +408,7 @@ class SyncManager:
 
                     logger.info(f"Processed {len(final_records)} records in {table}: {new_records} new, {updated_records} updated")
 
+            self._remember_company_ids(table, company_by_id)
             return changes_found
 
         except Exception as e:
@@ -390,15 +428,6 @@ class SyncManager:
             activities (pd.DataFrame): Optional pre-loaded activities data
             company_id (str): Company ID to sync data for
         """
-        # Calculate tempo_medio for each lead
-        if leads is not None and not leads.empty:
-            for idx, lead in leads.iterrows():
-                tempo_medio = self.supabase.calculate_response_time(
-                    lead['id'], lead['criado_em'])
-                leads.at[idx, 'tempo_medio'] = tempo_medio
-
-            # Calculate ticket_medio
-            self.supabase.calculate_ticket_medio(leads)
         try:
             if not company_id:
                 raise ValueError("company_id is required for sync_data")
@@ -436,13 +465,25 @@ class SyncManager:
                     f"No configuration found for company {company_id}")
                 return
 
-            # Carregar dados, se não fornecidos
-            if brokers is None:
-                brokers = self.kommo_api.get_users()
-            if leads is None:
-                leads = self.kommo_api.get_leads()
-            if activities is None:
-                activities = self.kommo_api.get_activities()
+            # Carregar dados, se não fornecidos: as três consultas à Kommo são
+            # independentes e rodam ao mesmo tempo
+            if brokers is None and leads is None and activities is None:
+                brokers, leads, activities = self.kommo_api.get_all_data()
+            elif brokers is None or leads is None or activities is None:
+                with ThreadPoolExecutor(max_workers=3) as executor:
+                    brokers_future = executor.submit(
+                        self.kommo_api.get_users) if brokers is None else None
+                    leads_future = executor.submit(
+                        self.kommo_api.get_leads) if leads is None else None
+                    activities_future = executor.submit(
+                        self.kommo_api.get_activities
+                    ) if activities is None else None
+                if brokers_future:
+                    brokers = brokers_future.result()
+                if leads_future:
+                    leads = leads_future.result()
+                if activities_future:
+                    activities = activities_future.result()
 
             # Processar Brokers
             if isinstance(brokers, pd.DataFrame) and not brokers.empty:
@@ -454,8 +495,6 @@ class SyncManager:
                 for i in range(0, len(brokers), broker_batch_size):
                     batch = brokers.iloc[i:i + broker_batch_size].to_dict('records')
                     self._process_batch(batch, 'brokers', existing_brokers)
-                    # Small delay between batches
-                    time.sleep(0.1)
 
                 logger.info(f"Processed {len(brokers)} brokers")
                 self.supabase.initialize_broker_points(company_id)
@@ -465,12 +504,11 @@ class SyncManager:
 
             # Obter IDs válidos de brokers ANTES de processar leads
             try:
-                broker_ids = self.supabase.client.table("brokers").select("id").eq("company_id", company_id).execute()
-                valid_broker_ids = {item['id'] for item in broker_ids.data} if broker_ids.data else set()
+                valid_broker_ids = self._valid_broker_ids(leads, activities, company_id)
                 logger.info(f"Found {len(valid_broker_ids)} valid broker IDs for company {company_id}")
             except Exception as e:
                 logger.error(f"Error getting valid broker IDs: {e}")
-                valid_broker_ids = set()
+                valid_broker_ids = None
 
             # Processar Leads com validação de foreign key
             if isinstance(leads, pd.DataFrame) and not leads.empty:
@@ -479,19 +517,26 @@ class SyncManager:
                 # Filtrar leads apenas com responsavel_id válido
                 original_count = len(leads)
                 if valid_broker_ids:
-                    leads_filtered = leads[
-                        leads['responsavel_id'].isin(valid_broker_ids) | 
-                        leads['responsavel_id'].isna()
-                    ].copy()
+                    leads_filtered = leads[self.supabase.existing_id_mask(
+                        leads['responsavel_id'], valid_broker_ids)]
                 else:
                     # Se não há brokers, só manter leads sem responsavel_id
-                    leads_filtered = leads[leads['responsavel_id'].isna()].copy()
+                    leads_filtered = leads[leads['responsavel_id'].isna()]
 
                 filtered_count = len(leads_filtered)
                 if filtered_count < original_count:
                     logger.warning(f"Filtered out {original_count - filtered_count} leads with invalid responsavel_id")
 
                 if not leads_filtered.empty:
+                    # Calculate tempo_medio for every lead that will be synced
+                    # at once: notes are fetched in bulk, in parallel chunks,
+                    # only for leads that passed the filter
+                    notes_by_lead = self.kommo_api.get_notes_for_leads(
+                        leads_filtered['id'].tolist())
+                    leads_filtered = leads_filtered.assign(
+                        tempo_medio=self.supabase.calculate_response_times(
+                            leads_filtered, notes_by_lead))
+
                     leads_batch_size = self.get_safe_batch_size('leads')
                     existing_leads = self._get_existing_records('leads')
 
@@ -499,8 +544,6 @@ class SyncManager:
                     for i in range(0, len(leads_filtered), leads_batch_size):
                         batch = leads_filtered.iloc[i:i + leads_batch_size].to_dict('records')
                         self._process_batch(batch, 'leads', existing_leads)
-                        # Small delay between batches
-                        time.sleep(0.1)
 
                     logger.info(f"Processed {len(leads_filtered)} leads")
                 else:
@@ -509,21 +552,23 @@ class SyncManager:
             # Processar Activities
             if isinstance(activities, pd.DataFrame) and not activities.empty:
                 # Obter IDs válidos
-                broker_ids = self.supabase.client.table("brokers").select(
-                    "id").eq("company_id", company_id).execute()
-                valid_broker_ids = {item['id'] for item in broker_ids.data} if broker_ids.data else set()
-
-                lead_ids = self.supabase.client.table("leads").select("id").eq(
-                    "company_id", company_id).execute()
-                valid_lead_ids = {item['id'] for item in lead_ids.data} if lead_ids.data else set()
+                # Brokers não mudam durante o processamento dos leads: reaproveita
+                # os ids já buscados e só consulta de novo se a busca falhou
+                if valid_broker_ids is None:
+                    valid_broker_ids = self._valid_broker_ids(leads, activities, company_id)
+                # Só os leads da empresa referenciados pelas atividades, via
+                # in_(), em vez de todos os ids de leads da empresa
+                valid_lead_ids = self.supabase.select_existing_ids(
+                    "leads", self.supabase.distinct_ids(activities, 'lead_id'),
+                    company_id=company_id)
 
                 activities['company_id'] = company_id
 
                 # Filter activities to only those with valid references
-                filtered_activities = activities[(
-                    (activities['lead_id'].isin(valid_lead_ids) | activities['lead_id'].isna()) &
-                    (activities['user_id'].isin(valid_broker_ids) | activities['user_id'].isna())
-                )].copy()
+                filtered_activities = activities[
+                    self.supabase.existing_id_mask(activities['lead_id'], valid_lead_ids) &
+                    self.supabase.existing_id_mask(activities['user_id'], valid_broker_ids)
+                ]
 
                 if filtered_activities.empty:
                     logger.warning("No valid activities found after filtering")
@@ -535,8 +580,6 @@ class SyncManager:
                     for i in range(0, len(filtered_activities), activities_batch_size):
                         batch = filtered_activities.iloc[i:i + activities_batch_size].to_dict('records')
                         self._process_batch(batch, 'activities', existing_activities)
-                        # Small delay between batches
-                        time.sleep(0.1)
 
                     logger.info(f"Processed {len(filtered_activities)} activities")
 
@@ -2,6 +2,7 @@ from flask import Flask, jsonify, request
 import threading
 import logging
 import time
+import random
 from datetime import datetime, timedelta
 from libs.supabase_db import SupabaseClient
 from libs.kommo_api import KommoAPI
@@ -91,15 +92,10 @@ def continuous_sync_worker(company_id, config):
 
                 logger.info(f"[{company_id}] Starting sync cycle #{sync_status[company_id]['total_syncs'] + 1}")
 
-                # Fetch ALL data without date filters
-                logger.info(f"[{company_id}] Fetching ALL brokers...")
-                brokers = kommo_api.get_users(active_only=False)  # Include all users
-
-                logger.info(f"[{company_id}] Fetching ALL leads...")
-                leads = kommo_api.get_leads()  # No date filters
-
-                logger.info(f"[{company_id}] Fetching ALL activities...")
-                activities = kommo_api.get_activities()  # No date filters
+                # Fetch ALL data without date filters (brokers, leads and activities in parallel)
+                logger.info(f"[{company_id}] Fetching ALL brokers, leads and activities...")
+                brokers, leads, activities = kommo_api.get_all_data(
+                    active_only=False)  # Include all users
 
                 # Add company_id to all DataFrames
                 if not brokers.empty:
@@ -126,10 +122,12 @@ def continuous_sync_worker(company_id, config):
 
                     # Filter only brokers with 'Corretor' role for points calculation
                     if not brokers.empty:
+                        # update_broker_points only reads the frame: the
+                        # boolean filter already returns a new one
                         broker_data = brokers[
                             (brokers['cargo'] == 'Corretor') & 
                             (brokers['company_id'] == company_id)
-                        ].copy()
+                        ]
 
                         if not broker_data.empty:
                             local_supabase.update_broker_points(
@@ -150,11 +148,12 @@ def continuous_sync_worker(company_id, config):
                 consecutive_errors = 0  # Reset error counter on success
 
                 sync_interval = adaptive_sync_interval(company_id, {'total_changes': total_changes})
-                next_sync_time = datetime.now() + timedelta(seconds=sync_interval)
+                last_sync_time = datetime.now()
+                next_sync_time = last_sync_time + timedelta(seconds=sync_interval)
 
                 sync_status[company_id].update({
                     'status': 'waiting',
-                    'last_sync': datetime.now(),
+                    'last_sync': last_sync_time,
                     'next_sync': next_sync_time,
                     'total_syncs': sync_status[company_id]['total_syncs'] + 1,
                     'last_changes': changes_detected,
@@ -196,7 +195,8 @@ def continuous_sync_worker(company_id, config):
                     error_delay = SYNC_CONFIG['max_interval'] * 2
                     logger.error(f"[{company_id}] Too many consecutive errors, backing off for {error_delay}s")
 
-                time.sleep(error_delay)
+                # Jitter so companies that failed together don't retry in lockstep
+                time.sleep(error_delay + random.uniform(0, 1))
 
     except Exception as fatal_error:
         logger.critical(f"[{company_id}] Fatal error in sync worker: {fatal_error}")
@@ -0,0 +1,45 @@
+
+-- Funções usadas por SupabaseClient.get_messages_for_brokers /
+-- get_messages_for_leads: as últimas p_limit mensagens de cada id em uma
+-- única chamada, em vez de uma consulta por broker ou lead
+CREATE OR REPLACE FUNCTION webhook_messages_top_n_by_broker(p_ids TEXT[], p_limit INTEGER)
+RETURNS SETOF from_webhook
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT m.*
+    FROM unnest(p_ids) WITH ORDINALITY AS b(id, ord)
+    CROSS JOIN LATERAL (
+        SELECT f.*
+        FROM from_webhook f
+        WHERE f.broker_id = b.id
+        ORDER BY f.inserted_at DESC
+        LIMIT p_limit
+    ) m
+    ORDER BY b.ord, m.inserted_at DESC;
+$$;
+
+CREATE OR REPLACE FUNCTION webhook_messages_top_n_by_lead(p_ids TEXT[], p_limit INTEGER)
+RETURNS SETOF from_webhook
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT m.*
+    FROM unnest(p_ids) WITH ORDINALITY AS l(id, ord)
+    CROSS JOIN LATERAL (
+        SELECT f.*
+        FROM from_webhook f
+        WHERE f.lead_id = l.id
+        ORDER BY f.inserted_at DESC
+        LIMIT p_limit
+    ) m
+    ORDER BY l.ord, m.inserted_at DESC;
+$$;
+
+-- Índices para que cada LIMIT leia só as mensagens mais recentes do id
+CREATE INDEX IF NOT EXISTS idx_from_webhook_broker_id_inserted_at ON from_webhook(broker_id, inserted_at DESC);
+CREATE INDEX IF NOT EXISTS idx_from_webhook_lead_id_inserted_at ON from_webhook(lead_id, inserted_at DESC);
+
+-- Comentários explicativos
+COMMENT ON FUNCTION webhook_messages_top_n_by_broker(TEXT[], INTEGER) IS 'Últimas p_limit mensagens de cada broker informado';
+COMMENT ON FUNCTION webhook_messages_top_n_by_lead(TEXT[], INTEGER) IS 'Últimas p_limit mensagens de cada lead informado';